@@ -4,7 +4,14 @@
 import time
 import traceback
 # 3rd Party Imports
+import gevent
 # Local Imports
+import Dedupe
+import Metrics
+from Dispatcher import get_current_deadline, get_current_events, get_time_left, mark_failed, \
+    mark_rendered, mark_stale
+from RateLimit import RateLimitError
+from Retry import CircuitBreaker, RetryPolicy
 from Utils import parse_boolean
 
 #####################################################  ATTENTION!  #####################################################
@@ -22,6 +29,8 @@ class Alarm(object):
         "gyms": {}
     }
 
+    _default_retry = RetryPolicy('Alarm', {})  # Used when sending without a policy of its own
+
     # Gather settings and create alarm
     def __init__(self):
         raise NotImplementedError("This is an abstract method.")
@@ -54,6 +63,15 @@ class Alarm(object):
     def gym_alert(self, pokegym_info):
         raise NotImplementedError("This is an abstract method.")
 
+    # Trigger alerts for several events of the same kind at once (services that can combine them override this)
+    def send_batch(self, kind, events):
+        for info in events:
+            getattr(self, '{}_alert'.format(kind))(info)
+
+    # Returns a dict of any counts the alarm keeps for reporting
+    def get_stats(self):
+        return {}
+
     # Return a version of the string with the correct substitutions made
     @staticmethod
     def replace(string, pkinfo):
@@ -64,15 +82,76 @@ class Alarm(object):
 
     # Attempts to send the alert with the specified args, reconnecting if neccesary
     @staticmethod
-    def try_sending(log, reconnect, name, send_alert, args):
-        for i in range(3):
-            try:
-                send_alert(**args)
-                return  # message sent successfully
-            except Exception as e:
-                log.error("Encountered error while sending notification ({}: {})".format(type(e).__name__, e))
-                log.debug("Stack trace: \n {}".format(traceback.format_exc()))
-                log.info("{} is having connection issues. {} attempt of 3.".format(name, i+1))
-                time.sleep(3)
+    def try_sending(log, reconnect, name, send_alert, args, policy=None, endpoint=None):
+        policy = policy or Alarm._default_retry
+        mark_rendered()  # The args are ready to go, so the time spent rendering them is over
+        # Overlapping Managers can have alarms pointed at the same place, so only the first identical send goes out
+        key, first = Dedupe.claim(endpoint, get_current_events(), [name, args],
+                                  get_current_deadline() or time.time() + 3600)
+        if not first:
+            log.debug("{} notification was already sent by another Manager.".format(name))
+            return
+        breaker = policy.get_breaker(endpoint or name)
+        if not breaker.allow():  # Fail fast instead of waiting on a service that is down
+            policy.fast_fails += 1
+            log.warning("{} is not responding... Skipping notification until it recovers.".format(name))
+            mark_failed()
+            Dedupe.release(key)
+            return
+        start, attempts, delivered = time.time(), 0, False
+        probing = breaker.state == CircuitBreaker.HALF_OPEN  # This send decides if the endpoint is back
+        try:
+            while attempts < policy.max_attempts:
+                time_left = get_time_left()  # Time until the notification is worthless (None if it never is)
+                if time_left is not None and time_left <= 0:
+                    log.warning("{} notification reached its deadline before it could be sent.".format(name))
+                    mark_stale()
+                    break
+                attempts += 1
+                # Raised as a BaseException, so the services' own 'except Exception' handlers can't swallow it
+                deadline = gevent.Timeout(time_left)
+                try:
+                    with deadline:
+                        send_alert(**args)
+                    breaker.record_success()
+                    probing, delivered = False, True
+                    break  # message sent successfully
+                except gevent.Timeout as e:
+                    if e is not deadline:
+                        raise  # Someone else's timeout
+                    # Not the service's fault, so leave the circuit alone
+                    log.warning("{} notification reached its deadline before it could be sent.".format(name))
+                    mark_stale()
+                    break
+                except RateLimitError as e:  # The rate limiter will hold the next attempt for as long as needed
+                    log.warning("{} is being rate limited (retry after {:.2f}s). {} attempt of {}.".format(
+                        name, e.retry_after, attempts, policy.max_attempts))
+                    continue
+                except Exception as e:
+                    log.error("Encountered error while sending notification ({}: {})".format(type(e).__name__, e))
+                    log.debug("Stack trace: \n {}".format(traceback.format_exc()))
+                    log.info("{} is having connection issues. {} attempt of {}.".format(
+                        name, attempts, policy.max_attempts))
+                    breaker.record_failure()
+                    probing = False
+                delay = policy.get_delay(attempts - 1)
+                if attempts >= policy.max_attempts or time.time() - start + delay > policy.max_elapsed \
+                        or (time_left is not None and delay >= get_time_left()) or not breaker.allow():
+                    log.error("Could not send notification... Giving up.")
+                    mark_failed()
+                    break
+                probing = breaker.state == CircuitBreaker.HALF_OPEN  # allow() may have just let this send probe
+                time.sleep(delay)
                 reconnect()
-        log.error("Could not send notification... Giving up.")
+            else:
+                log.error("Could not send notification... Giving up.")
+                mark_failed()
+        finally:
+            if probing:  # Ended without a verdict, so let the next send find out if the endpoint is back
+                breaker.release_probe()
+        if not delivered:  # Let another Manager have a go at it
+            Dedupe.release(key)
+        if attempts > 1:  # Keep track of the time spent on retries
+            policy.retries += attempts - 1
+            policy.retry_time += time.time() - start
+            Metrics.inc('pokealarm_alarm_retries_total', {'service': name}, attempts - 1)
@@ -0,0 +1,90 @@
+# Standard Library Imports
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import struct
+import time
+# 3rd Party Imports
+# Local Imports
+
+log = logging.getLogger('Dedupe')
+
+# Table shared by every Manager (created by the main process before the Managers are started)
+_table = None
+_skipped = 0  # Duplicates skipped by this process
+
+
+# Remembers recent sends in shared memory so that only the first of several identical sends goes out
+class SendTable(object):
+
+    _slot = struct.Struct('<Qd')  # 64-bit hash of the send and when it can be forgotten
+    _probes = 8  # Slots checked for each hash before the one closest to expiring is reused
+
+    def __init__(self, slots):
+        self.__slots = slots
+        self.__map = mmap.mmap(-1, slots * self._slot.size)  # Anonymous, so it is shared with forked processes
+        self.__lock = multiprocessing.Lock()
+
+    # Returns true if this is the first send with the given key (and remembers it until it expires)
+    def claim(self, key, expires):
+        now = time.time()
+        with self.__lock:
+            best, best_expires = None, None
+            for i in range(self._probes):
+                offset = ((key + i) % self.__slots) * self._slot.size
+                slot_key, slot_expires = self._slot.unpack_from(self.__map, offset)
+                if slot_expires <= now:  # Empty or expired
+                    if best is None or best_expires > 0:
+                        best, best_expires = offset, 0
+                elif slot_key == key:
+                    return False
+                elif best is None or slot_expires < best_expires:
+                    best, best_expires = offset, slot_expires
+            self._slot.pack_into(self.__map, best, key, expires)
+            return True
+
+    # Forget a send so that another process can try it (used when a send fails)
+    def release(self, key):
+        with self.__lock:
+            for i in range(self._probes):
+                offset = ((key + i) % self.__slots) * self._slot.size
+                if self._slot.unpack_from(self.__map, offset)[0] == key:
+                    self._slot.pack_into(self.__map, offset, 0, 0)
+                    return
+
+
+# Create the shared table (must be called before the Managers are started, 0 slots disables deduping)
+def create_table(slots):
+    global _table
+    _table = SendTable(slots) if slots > 0 else None
+
+
+# Returns a 64-bit key for a send to the given destination for the given events with the given content
+def make_key(destination, events, content):
+    data = json.dumps([destination, events, content], sort_keys=True, default=repr)
+    return struct.unpack('<Q', hashlib.sha1(data).digest()[:8])[0] or 1  # 0 marks an empty slot
+
+
+# Returns the key for the send and whether it should go out (false if another Manager has already made it)
+def claim(destination, events, content, expires):
+    global _skipped
+    if _table is None or destination is None or events is None:
+        return None, True
+    key = make_key(destination, events, content)
+    if _table.claim(key, expires):
+        return key, True
+    _skipped += 1
+    return key, False
+
+
+# Let the send be tried again by other Managers
+def release(key):
+    if _table is not None and key is not None:
+        _table.release(key)
+
+
+# Returns the number of duplicate sends skipped by this process
+def get_skipped():
+    return _skipped
@@ -0,0 +1,70 @@
+# Standard Library Imports
+import logging
+import time
+# 3rd Party Imports
+import gevent
+# Local Imports
+from Dispatcher import get_current_deadline, set_current_deadline
+from Utils import reject_leftover_parameters
+
+log = logging.getLogger('Digest')
+
+
+# Collects alerts for each destination and sends them as a single summary on a schedule or once enough pile up
+class Digest(object):
+
+    def __init__(self, name, settings, send, max_length):
+        self.__name = name
+        self.__send = send  # Called with the destination and the rendered summary
+        self.__interval = float(settings.pop('interval', 60))  # Seconds to collect alerts before sending
+        self.__max_events = int(settings.pop('max_events', 10))  # Send early once this many are waiting
+        self.__max_length = int(settings.pop('max_length', max_length))  # Longest summary the service allows
+        reject_leftover_parameters(settings, "'digest' settings of {} alarm.".format(name))
+        self.__pending = {}  # destination -> list of (text, deadline)
+
+    # Add the rendered alert to the summary for the destination
+    def add(self, destination, text):
+        events = self.__pending.get(destination)
+        if events is None:
+            events = self.__pending[destination] = []
+            gevent.spawn_later(self.__interval, self.flush, destination, events)
+        events.append((text, get_current_deadline()))
+        if len(events) >= self.__max_events:
+            self.flush(destination, events)
+
+    # Send the summary of the alerts that are still worth sending
+    def flush(self, destination, events):
+        if self.__pending.get(destination) is not events:
+            return  # Already sent
+        del self.__pending[destination]
+        now = time.time()
+        live = [(text, deadline) for text, deadline in events if deadline is None or deadline > now]
+        if len(live) < len(events):
+            log.debug("{} digest dropped {} expired alert(s).".format(self.__name, len(events) - len(live)))
+        if len(live) == 0:
+            return
+        deadlines = [deadline for text, deadline in live]
+        previous = get_current_deadline()
+        set_current_deadline(None if None in deadlines else max(deadlines))
+        try:
+            log.debug("Sending {} digest of {} alert(s).".format(self.__name, len(live)))
+            self.__send(destination, self.render([text for text, deadline in live]))
+        finally:
+            set_current_deadline(previous)
+
+    # Returns the alerts as one message, leaving off (and counting) any that don't fit
+    def render(self, texts):
+        lines = [text.decode('utf-8') if isinstance(text, str) else text for text in texts]
+        body = u''
+        for i, line in enumerate(lines):
+            left = len(lines) - i - 1
+            more = u'\n(+{} more)'.format(left) if left > 0 else u''
+            candidate = body + (u'\n' if len(body) > 0 else u'') + line
+            if len(candidate) + len(more) <= self.__max_length:
+                body = candidate
+            elif len(body) == 0:  # Even the first one is too long, so cut it short
+                body = line[:max(0, self.__max_length - len(more) - 3)] + u'...'
+            else:
+                body += u'\n(+{} more)'.format(left + 1)
+                break
+        return body.encode('utf-8')
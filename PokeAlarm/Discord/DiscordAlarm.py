@@ -1,9 +1,15 @@
 # Standard Library Imports
 import logging
 import requests
+import time
 # 3rd Party Imports
+import gevent
 # Local Imports
 from ..Alarm import Alarm
+from ..Dispatcher import get_current_deadline, set_current_deadline
+from ..Retry import RetryPolicy
+from ..HttpPool import get_session, get_timeout
+from ..RateLimit import RateLimitError, get_bucket
 from ..Utils import parse_boolean, get_static_map_url, reject_leftover_parameters, require_and_remove_key
 
 log = logging.getLogger('Discord')
@@ -19,6 +25,8 @@ replace = Alarm.replace
 
 class DiscordAlarm(Alarm):
 
+    _max_embeds = 10  # Most embeds Discord will accept in a single message
+
     _defaults = {
         'pokemon': {
             'username': "<pkmn>",
@@ -50,6 +58,8 @@ class DiscordAlarm(Alarm):
 
         # Optional Alarm Parameters
         self.__startup_message = parse_boolean(settings.pop('startup_message', "True"))
+        self.__retry = RetryPolicy('Discord', settings.pop('retry', {}))  # How to handle failed messages
+        self.__batch_window = float(settings.pop('batch_window', 0))  # Seconds to wait for alerts to combine
         self.__map = settings.pop('map', {})  # default for the rest of the alerts
         self.__static_map_key = static_map_key
 
@@ -58,6 +68,9 @@ class DiscordAlarm(Alarm):
         self.__pokestop = self.create_alert_settings(settings.pop('pokestop', {}), self._defaults['pokestop'])
         self.__gym = self.create_alert_settings(settings.pop('gym', {}), self._defaults['gym'])
 
+        self.__batches = {}  # Alerts waiting to be combined for each webhook
+        self.__requests, self.__alerts = 0, 0
+
         # Warn user about leftover parameters
         reject_leftover_parameters(settings, "'Alarm level in Discord alarm.")
 
@@ -77,7 +90,7 @@ class DiscordAlarm(Alarm):
                     'content': 'PokeAlarm activated!'
                 }
             }
-            try_sending(log, self.connect, "Discord", self.send_webhook, args)
+            try_sending(log, self.connect, "Discord", self.send_webhook, args, self.__retry, self.__webhook_url)
             log.info("Startup message sent!")
 
     # Set the appropriate settings for each alert
@@ -98,22 +111,86 @@ class DiscordAlarm(Alarm):
     # Send Alert to Discord
     def send_alert(self, alert, info):
         log.debug("Attempting to send notification to Discord.")
-        payload = {
-            'username': replace(alert['username'], info),
-            'embeds': [{
-                'title': replace(alert['title'], info),
-                'url': replace(alert['url'], info),
-                'description': replace(alert['body'], info),
-                'thumbnail': {'url': replace(alert['icon_url'], info)}
-            }]
-        }
-        if alert['map'] is not None:
-            payload['embeds'][0]['image'] = {'url': replace(alert['map'], {'lat': info['lat'], 'lng': info['lng']})}
+        username, embed = replace(alert['username'], info), self.create_embed(alert, info)
+        if self.__batch_window > 0:
+            self.add_to_batch(alert['webhook_url'], username, embed)
+            return
         args = {
             'url': alert['webhook_url'],
-            'payload': payload
+            'payload': {
+                'username': username,
+                'embeds': [embed]
+            }
+        }
+        self.__requests += 1
+        self.__alerts += 1
+        try_sending(log, self.connect, "Discord", self.send_webhook, args, self.__retry, alert['webhook_url'])
+
+    # Send Alerts for several events at once, as few messages as possible
+    def send_batch(self, kind, events):
+        log.debug("Attempting to send {} notifications to Discord.".format(len(events)))
+        alert = {'pokemon': self.__pokemon, 'pokestop': self.__pokestop, 'gym': self.__gym}[kind]
+        if self.__batch_window > 0:  # Let them be combined with any others that show up
+            for info in events:
+                self.send_alert(alert, info)
+            return
+        deadline = get_current_deadline()
+        entries = [(replace(alert['username'], info), self.create_embed(alert, info), deadline) for info in events]
+        for i in range(0, len(entries), self._max_embeds):
+            self.post_embeds(alert['webhook_url'], entries[i:i + self._max_embeds])
+
+    # Returns the embed describing the event
+    def create_embed(self, alert, info):
+        embed = {
+            'title': replace(alert['title'], info),
+            'url': replace(alert['url'], info),
+            'description': replace(alert['body'], info),
+            'thumbnail': {'url': replace(alert['icon_url'], info)}
         }
-        try_sending(log, self.connect, "Discord", self.send_webhook, args)
+        if alert['map'] is not None:
+            embed['image'] = {'url': replace(alert['map'], {'lat': info['lat'], 'lng': info['lng']})}
+        return embed
+
+    # Hold the alert to be sent along with any others for the same webhook that arrive within the batch window
+    def add_to_batch(self, url, username, embed):
+        batch = self.__batches.get(url)
+        if batch is None:
+            batch = self.__batches[url] = []
+            gevent.spawn_later(self.__batch_window, self.flush_batch, url, batch)
+        batch.append((username, embed, get_current_deadline()))
+        if len(batch) >= self._max_embeds:  # Full, so there is no reason to wait
+            self.flush_batch(url, batch)
+
+    # Send the held alerts for a webhook as a single message
+    def flush_batch(self, url, batch):
+        if self.__batches.get(url) is not batch:
+            return  # Already sent
+        del self.__batches[url]
+        now = time.time()
+        batch = [entry for entry in batch if entry[2] is None or entry[2] > now]  # Drop expired alerts
+        if len(batch) > 0:
+            self.post_embeds(url, batch)
+
+    # Post a list of (username, embed, deadline) to the webhook as a single message
+    def post_embeds(self, url, entries):
+        usernames = set(username for username, embed, deadline in entries)
+        if len(usernames) == 1:
+            payload = {'username': usernames.pop(), 'embeds': [embed for username, embed, deadline in entries]}
+        else:  # A message only has one username, so credit each alert in its embed instead
+            payload = {'username': 'PokeAlarm', 'embeds': []}
+            for username, embed, deadline in entries:
+                embed['author'] = {'name': username}
+                payload['embeds'].append(embed)
+        deadlines = [deadline for username, embed, deadline in entries]
+        previous = get_current_deadline()
+        set_current_deadline(None if None in deadlines else max(deadlines))  # Worth sending while any are useful
+        try:
+            self.__requests += 1
+            self.__alerts += len(entries)
+            try_sending(log, self.connect, "Discord", self.send_webhook, {'url': url, 'payload': payload},
+                        self.__retry, url)
+        finally:
+            set_current_deadline(previous)
 
     # Trigger an alert based on Pokemon info
     def pokemon_alert(self, pokemon_info):
@@ -130,10 +207,49 @@ class DiscordAlarm(Alarm):
         log.debug("Gym notification triggered.")
         self.send_alert(self.__gym, gym_info)
 
+    # Returns the number of messages posted and the alerts they contained
+    def get_stats(self):
+        return {'requests': self.__requests, 'alerts': self.__alerts}
+
     def send_webhook(self, url, payload):
-        resp = requests.post(url, json=payload, timeout=(None, 5))
+        # Each webhook has its own limit (5 requests every 2 seconds unless Discord tells us otherwise)
+        bucket = get_bucket(url, "Discord webhook {}".format(url.rstrip('/').split('/')[-2]), 2.5, 5)
+        bucket.acquire()
+        resp = get_session().post(url, json=payload, timeout=get_timeout())
+        headers = resp.headers
+        reset_after = get_header(headers, 'X-RateLimit-Reset-After', float)
+        if reset_after is None and get_header(headers, 'X-RateLimit-Reset', float) is not None:
+            reset_after = max(0.0, get_header(headers, 'X-RateLimit-Reset', float) - time.time())
+        bucket.update(limit=get_header(headers, 'X-RateLimit-Limit', int),
+                      remaining=get_header(headers, 'X-RateLimit-Remaining', int),
+                      reset_after=reset_after)
+        if resp.status_code == 429:
+            # The body and X-RateLimit-Reset-After give the wait in seconds (with fractions), Retry-After in whole
+            # seconds - wait for the longest, since a global limit can outlast the webhook's own
+            waits = [wait for wait in (get_body_value(resp, 'retry_after', float), reset_after,
+                                       get_header(headers, 'Retry-After', float)) if wait is not None]
+            retry_after = max(waits) if len(waits) > 0 else 1.0
+            bucket.pause(retry_after)
+            raise RateLimitError("Response received 429, webhook is being rate limited.", retry_after)
         if resp.ok is True:
             log.debug("Notification successful (returned {})".format(resp.status_code))
         else:
             raise requests.exceptions.RequestException(
                 "Response received {}, webhook not accepted.".format(resp.status_code))
+
+
+# Returns the value of a response header converted to the given type (or None if missing or malformed)
+def get_header(headers, name, type_):
+    try:
+        return type_(headers[name]) if name in headers else None
+    except ValueError:
+        return None
+
+
+# Returns a value from a JSON response body converted to the given type (or None if missing or malformed)
+def get_body_value(resp, name, type_):
+    try:
+        body = resp.json()
+        return type_(body[name]) if isinstance(body, dict) and name in body else None
+    except (ValueError, TypeError):
+        return None
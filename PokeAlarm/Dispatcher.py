@@ -0,0 +1,284 @@
+# Standard Library Imports
+import calendar
+from collections import OrderedDict
+import logging
+import time
+import traceback
+# 3rd Party Imports
+import gevent
+from gevent.local import local
+from gevent.queue import Empty, Queue
+# Local Imports
+import Metrics
+import Trace
+
+log = logging.getLogger('Dispatcher')
+
+# Details about the notification that the current greenlet is sending
+_context = local()
+
+
+# Returns the deadline of the notification being sent by this greenlet (None if it has none)
+def get_current_deadline():
+    return getattr(_context, 'deadline', None)
+
+
+# Set the deadline for whatever this greenlet sends next (for alarms that send from greenlets of their own)
+def set_current_deadline(deadline):
+    _context.deadline = deadline
+
+
+# Returns the seconds left before the notification being sent by this greenlet is worthless (None if no deadline)
+def get_time_left():
+    deadline = get_current_deadline()
+    return deadline - time.time() if deadline is not None else None
+
+
+# Returns the ids of the events being sent by this greenlet (None if it isn't sending events)
+def get_current_events():
+    return getattr(_context, 'events', None)
+
+
+# Note that the notification being sent by this greenlet could not be delivered (so it can be tried again later)
+def mark_failed():
+    _context.failed = True
+
+
+# Note that the notification being sent by this greenlet ran out of time before it could be delivered
+def mark_stale():
+    _context.stale = True
+
+
+# Note that the notification being sent by this greenlet has been rendered (only the first call counts)
+def mark_rendered():
+    if getattr(_context, 'rendered_at', None) is None:
+        _context.rendered_at = time.time()
+
+
+# Returns when the notification stops being useful (as a timestamp), or None if it never does
+def get_deadline(kind, info):
+    if kind == 'pokemon':
+        expires = info['disappear_time']
+    elif kind == 'pokestop':
+        expires = info['expire_time']
+    else:
+        return None
+    return calendar.timegm(expires.utctimetuple()) + expires.microsecond / 1000000.0
+
+
+# Queues up notifications for a single alarm and sends them out with a pool of worker greenlets
+class AlarmDispatcher(object):
+
+    _sync_interval = 1.0  # Seconds between writes of the outbox to disk
+    _requeue_delay = 30.0  # Seconds to wait before trying an undelivered notification again
+    _max_age = 3600.0  # Seconds to keep trying notifications that never expire
+
+    def __init__(self, name, alarm, concurrency, min_remaining, batch_size, batch_wait, outbox=None):
+        self.__name = name
+        self.__alarm = alarm
+        self.__concurrency = max(1, concurrency)
+        self.__min_remaining = min_remaining  # Drop notifications with less time left than this
+        self.__batch_size = max(1, batch_size)  # Most notifications handed to the alarm at once
+        self.__batch_wait = batch_wait  # Seconds to wait for a batch to fill up
+        self.__queue = Queue()
+        self.__in_flight = 0
+        self.__sent, self.__errors, self.__stale, self.__requeued = 0, 0, 0, 0
+        self.__workers = []
+
+        # Journal of the notifications that haven't been delivered yet (None unless the alarm is durable)
+        self.__outbox = outbox
+        self.__unacked = OrderedDict()  # id -> [id, kind, info, deadline, queued_at]
+        self.__next_id = 0
+
+    # Start up the workers (must be called in the process that will be sending)
+    def start(self):
+        if self.__outbox is not None:
+            self.restore_outbox()
+            self.__workers.append(gevent.spawn(self.sync_outbox))
+        for i in range(self.__concurrency):
+            self.__workers.append(gevent.spawn(self.work))
+        log.debug("{} started with {} worker(s).".format(self.__name, self.__concurrency))
+
+    # Add a notification to the queue ('kind' is one of pokemon, pokestop, or gym)
+    def put(self, kind, info):
+        self.__next_id += 1
+        record = [self.__next_id, kind, info, get_deadline(kind, info), time.time()]
+        if self.__outbox is not None:
+            try:
+                self.__outbox.append(['put'] + record)  # Only buffered here, sync_outbox does the writing
+                self.__unacked[record[0]] = record
+            except Exception as e:
+                log.error("{} could not save {} notification to its outbox: {}: {}".format(
+                    self.__name, kind, type(e).__name__, e))
+        self.__queue.put(record)
+
+    # Pull notifications off of the queue and send them until the end of time
+    def work(self):
+        while True:
+            batch = [self.__queue.get()]
+            stop = time.time() + self.__batch_wait
+            while len(batch) < self.__batch_size:
+                try:
+                    batch.append(self.__queue.get(timeout=max(0, stop - time.time())))
+                except Empty:
+                    break
+            kinds = []
+            for record in batch:
+                if record[1] not in kinds:
+                    kinds.append(record[1])
+            for kind in kinds:
+                self.send(kind, [record for record in batch if record[1] == kind])
+
+    # Hand notifications of the same kind to the alarm (dropping any that would arrive too late)
+    def send(self, kind, records):
+        now = time.time()
+        live, stale = [], []
+        for record in records:
+            if record[3] is None or record[3] - now >= self.__min_remaining:
+                live.append(record)
+            else:
+                stale.append(record)
+        if len(stale) > 0:
+            self.__stale += len(stale)
+            Metrics.inc('pokealarm_alarm_stale_total', {'alarm': self.__name}, len(stale))
+            self.ack(stale)
+            log.info("{} dropped {} {} notification(s) that would arrive too late.".format(
+                self.__name, len(stale), kind))
+        if len(live) == 0:
+            return
+        deadlines = [record[3] for record in live]
+        self.__in_flight += len(live)
+        set_current_deadline(None if None in deadlines else max(deadlines))  # Worth sending while any are useful
+        _context.events = [record[2].get('id') for record in live]
+        _context.failed, _context.stale = False, False
+        _context.rendered_at = None
+        start, outcome = time.time(), 'failed'
+        try:
+            if len(live) == 1:
+                getattr(self.__alarm, '{}_alert'.format(kind))(live[0][2])
+            else:
+                self.__alarm.send_batch(kind, [record[2] for record in live])
+            if _context.failed:
+                self.__errors += len(live)
+                Metrics.inc('pokealarm_alarm_failures_total', {'alarm': self.__name}, len(live))
+            elif _context.stale:  # Past its deadline, so there is no point holding on to it
+                self.__stale += len(live)
+                Metrics.inc('pokealarm_alarm_stale_total', {'alarm': self.__name}, len(live))
+                outcome = 'stale'
+            else:
+                self.__sent += len(live)
+                Metrics.inc('pokealarm_alarm_sends_total', {'alarm': self.__name}, len(live))
+                outcome = 'sent'
+        except Exception as e:
+            self.__errors += len(live)
+            Metrics.inc('pokealarm_alarm_failures_total', {'alarm': self.__name}, len(live))
+            log.error("{} encountered error while sending {} notification: {}: {}".format(
+                self.__name, kind, type(e).__name__, e))
+            log.debug("Stack trace: \n {}".format(traceback.format_exc()))
+        finally:
+            Metrics.observe('pokealarm_alarm_send_seconds', time.time() - start, {'alarm': self.__name})
+            set_current_deadline(None)
+            _context.events = None
+            self.__in_flight -= len(live)
+            self.finish_traces(kind, live, outcome)
+        if _context.failed and self.__outbox is not None:  # Hold on to them until the service is back
+            gevent.spawn_later(self._requeue_delay, self.requeue, live)
+        else:
+            self.ack(live)
+
+    # Record how long each notification took to get through every stage
+    def finish_traces(self, kind, records, outcome):
+        now = time.time()
+        for record in records:
+            if record[2].get('trace') is None:
+                continue
+            trace = dict(record[2]['trace'])  # Each alarm gets its own copy
+            Trace.mark(trace, 'rendered', _context.rendered_at or now)
+            Trace.mark(trace, 'sent', now)
+            Trace.finish(trace, kind, record[2].get('id'), self.__name, outcome)
+
+    # Put undelivered notifications back on the queue if they are still worth sending
+    def requeue(self, records):
+        now = time.time()
+        for record in records:
+            if (record[3] is not None and record[3] <= now) or now - record[4] > self._max_age:
+                self.__stale += 1
+                self.ack([record])
+            else:
+                self.__requeued += 1
+                self.__queue.put(record)
+
+    # Mark notifications as finished so that they aren't sent again after a restart
+    def ack(self, records):
+        if self.__outbox is None:
+            return
+        for record in records:
+            if self.__unacked.pop(record[0], None) is not None:
+                self.__outbox.append(['ack', record[0]])
+
+    # Queue up any notifications left in the outbox by the last run (skipping any that are no longer useful)
+    def restore_outbox(self):
+        start = time.time()
+        pending = OrderedDict()
+        try:
+            for record in self.__outbox.replay():
+                if record[0] == 'put':
+                    pending[record[1]] = record[1:]
+                elif record[0] == 'ack':
+                    pending.pop(record[1], None)
+        except Exception as e:
+            log.error("{} could not read its outbox: {}: {}".format(self.__name, type(e).__name__, e))
+            log.debug("Stack trace: \n {}".format(traceback.format_exc()))
+        expired = 0
+        for record in pending.values():
+            self.__next_id = max(self.__next_id, record[0])
+            if (record[3] is not None and record[3] - start < self.__min_remaining) \
+                    or start - record[4] > self._max_age:
+                expired += 1
+                continue
+            self.__unacked[record[0]] = record
+            self.__queue.put(record)
+        self.compact_outbox()
+        log.info("{} restored {} notification(s) from its outbox ({} expired) in {:.3f}s.".format(
+            self.__name, len(self.__unacked), expired, time.time() - start))
+
+    # Write the outbox to disk every so often, compacting it once it has grown too much
+    def sync_outbox(self):
+        while True:
+            gevent.sleep(self._sync_interval)
+            try:
+                if self.__outbox.size() > 2 * len(self.__unacked) + 1000:
+                    self.compact_outbox()
+                else:
+                    self.__outbox.flush(sync=True)
+            except Exception as e:
+                log.error("{} could not write its outbox: {}: {}".format(self.__name, type(e).__name__, e))
+                log.debug("Stack trace: \n {}".format(traceback.format_exc()))
+
+    # Replace the outbox with just the notifications that haven't been delivered
+    def compact_outbox(self):
+        self.__outbox.rewrite([['put'] + record for record in self.__unacked.values()])
+
+    # Write out anything that hasn't been saved yet
+    def close(self):
+        if self.__outbox is not None:
+            self.__outbox.close()
+
+    def get_name(self):
+        return self.__name
+
+    # Returns how long the oldest notification in the queue has been waiting
+    def get_lag(self, now):
+        return now - self.__queue.queue[0][4] if self.__queue.qsize() > 0 else 0.0
+
+    # Returns a dict of the current queue depth and the number of notifications being sent
+    def get_stats(self):
+        return {
+            'queued': self.__queue.qsize(),
+            'in_flight': self.__in_flight,
+            'sent': self.__sent,
+            'errors': self.__errors,
+            'dropped_stale': self.__stale,
+            'requeued': self.__requeued,
+            'alarm': self.__alarm.get_stats()
+        }
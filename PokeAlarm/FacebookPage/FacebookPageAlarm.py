@@ -5,6 +5,8 @@ import logging
 import facebook
 # Local Imports
 from ..Alarm import Alarm
+from ..Digest import Digest
+from ..Retry import RetryPolicy
 from ..Utils import parse_boolean, get_time_as_str, reject_leftover_parameters, require_and_remove_key
 
 log = logging.getLogger(__name__)
@@ -44,6 +46,9 @@ class FacebookPageAlarm(Alarm):
 
         # Optional Alarm Parameters
         self.__startup_message = parse_boolean(settings.pop('startup_message', "True"))
+        self.__retry = RetryPolicy('FacebookPage', settings.pop('retry', {}))  # How to handle failed messages
+        digest = settings.pop('digest', None)  # Post alerts as a summary every so often instead
+        self.__digest = Digest('FacebookPage', digest, self.send_digest, 5000) if digest is not None else None
 
         # Set Alerts
         self.__pokemon = self.create_alert_settings(settings.pop('pokemon', {}), self._defaults['pokemon'])
@@ -77,6 +82,9 @@ class FacebookPageAlarm(Alarm):
 
     # Post Pokemon Message
     def send_alert(self, alert, info):
+        if self.__digest is not None:  # Links are included in the text, since a post can only have one
+            self.__digest.add(None, replace(alert['message'], info) + ' ' + replace(alert['link'], info))
+            return
         self.post_to_wall(
             message=replace(alert['message'], info),
             attachment={"link": replace(alert['link'], info)}
@@ -94,9 +102,13 @@ class FacebookPageAlarm(Alarm):
     def gym_alert(self, gym_info):
         self.send_alert(self.__gym, gym_info)
 
+    # Post a summary of alerts
+    def send_digest(self, destination, message):
+        self.post_to_wall(message)
+
     # Sends a wall post to Facebook
     def post_to_wall(self, message, attachment=None):
         args = {"message": message}
         if attachment is not None:
             args['attachment'] = attachment
-        try_sending(log, self.connect, "FacebookPage", self.__client.put_wall_post, args)
+        try_sending(log, self.connect, "FacebookPage", self.__client.put_wall_post, args, self.__retry)
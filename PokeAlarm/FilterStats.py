@@ -0,0 +1,82 @@
+# Standard Library Imports
+import logging
+# 3rd Party Imports
+# Local Imports
+
+log = logging.getLogger('FilterStats')
+
+
+# Counts how often each filter is checked, passes, and which check turns events away - kept cheap for the hot path
+class FilterStats(object):
+
+    def __init__(self):
+        self.__filters = {}  # (kind, key) -> {filter index -> [matched, {check -> rejected}]}
+        self.__species = {}  # pkmn_id -> [events checked, seconds spent checking them]
+
+    def __get(self, kind, key, index):
+        counts = self.__filters.setdefault((kind, key), {}).get(index)
+        if counts is None:
+            counts = self.__filters[(kind, key)][index] = [0, {}]
+        return counts
+
+    # Count an event passing the filter
+    def matched(self, kind, key, index):
+        self.__get(kind, key, index)[0] += 1
+
+    # Count the filter turning an event away because of the given check
+    def rejected(self, kind, key, index, check):
+        rejected = self.__get(kind, key, index)[1]
+        rejected[check] = rejected.get(check, 0) + 1
+
+    # Add to the time spent checking events of a species against its filters
+    def add_time(self, pkmn_id, seconds):
+        species = self.__species.get(pkmn_id)
+        if species is None:
+            species = self.__species[pkmn_id] = [0, 0.0]
+        species[0] += 1
+        species[1] += seconds
+
+    # Returns the counts for each filter of the kind and key (filter index -> dict)
+    def get_filters(self, kind, key):
+        return dict((index, {
+            'evaluated': matched + sum(rejected.values()),
+            'matched': matched,
+            'rejected': dict(rejected)
+        }) for index, (matched, rejected) in self.__filters.get((kind, key), {}).items())
+
+    # Returns the number of events checked and seconds spent on the species
+    def get_time(self, pkmn_id):
+        events, seconds = self.__species.get(pkmn_id, (0, 0.0))
+        return {'events': events, 'seconds': seconds}
+
+
+# Learns which filters of each species match most often, so that they can be tried first (which one matches first
+# doesn't change whether an event passes, since passing any filter is enough)
+class FilterOrder(object):
+
+    _reorder_every = 100  # Matches of a species between updates of its order
+
+    def __init__(self):
+        self.__species = {}  # pkmn_id -> [order to try the filters in, matches of each filter, matches since update]
+
+    # Returns the indexes of the species' filters in the order they should be tried
+    def get(self, pkmn_id, count):
+        species = self.__species.get(pkmn_id)
+        if species is None or len(species[0]) != count:
+            species = self.__species[pkmn_id] = [range(count), [0] * count, 0]
+        return species[0]
+
+    # Count a match of the filter, updating the order now and then
+    def matched(self, pkmn_id, index):
+        species = self.__species.get(pkmn_id)
+        if species is None:
+            return
+        species[1][index] += 1
+        species[2] += 1
+        if species[2] >= self._reorder_every:
+            order = sorted(range(len(species[1])), key=lambda i: -species[1][i])  # Stable, so ties keep file order
+            if order != species[0]:
+                log.debug("Filter order for #{} changed to {}.".format(pkmn_id, order))
+            species[0] = order
+            species[1] = [matches / 2 for matches in species[1]]  # Let older matches fade so the order can change
+            species[2] = 0
@@ -1,10 +1,12 @@
 # Standard Library Imports
+from bisect import bisect_left
+from math import asin, cos, pi, radians, sin, sqrt
 import sys
 import logging
 # 3rd Party Imports
 # Local Imports
 from Utils import parse_boolean, reject_leftover_parameters, get_team_id, get_move_id, get_pkmn_id, require_and_remove_key, \
-    get_dist_as_str
+    get_dist_as_str, get_earth_radius
 
 
 log = logging.getLogger('Filters')
@@ -206,6 +208,16 @@ class PokemonFilter(Filter):
             return True
         return size in self.sizes
 
+    # Returns true if this filter depends on information that only arrives with the IVs (encounter data)
+    def uses_iv(self):
+        return self.ignore_missing or not (
+            self.min_iv <= 0.0 and self.max_iv >= 100.0 and
+            self.min_atk <= 0 and self.max_atk >= 15 and
+            self.min_def <= 0 and self.max_def >= 15 and
+            self.min_sta <= 0 and self.max_sta >= 15 and
+            self.req_quick_move is None and self.req_charge_move is None and
+            self.req_moveset is None and self.sizes is None)
+
     # Convert this filter to a dict
     def to_dict(self):
         return {
@@ -343,6 +355,64 @@ class GymFilter(Filter):
         return s
 
 
+# The distances from a center that at least one of a group of filters allows, for turning away events that none of
+# them will pass without working out the exact distance.
+#
+# Points are first checked against a box around the outermost ring, then against a flat-earth (equirectangular)
+# approximation of their distance. Within _max_approx of the center and _max_lat of the equator, the approximation
+# is within _tolerance of the great-circle distance (the worst seen in testing is ~0.04%, so this leaves a wide
+# margin), and points that are closer than that to the edge of a ring are left for the exact check. So a point is
+# only turned away if get_earth_dist would have put it outside every ring too.
+class DistanceRings(object):
+
+    _tolerance = 0.01  # Largest relative error of the approximation
+    _max_approx = 100000.0 / 6373000  # Farthest (in radians, ~100km) that the approximation is used
+    _max_lat = radians(79)  # Farthest from the equator that the approximation is used
+
+    def __init__(self, rings, center):
+        radius = float(get_earth_radius())
+        self.__rings = []  # Sorted, non-overlapping (min, max) ranges in radians
+        for low, high in sorted((low / radius, high / radius) for low, high in rings):
+            if len(self.__rings) > 0 and low <= self.__rings[-1][1]:
+                self.__rings[-1] = (self.__rings[-1][0], max(high, self.__rings[-1][1]))
+            else:
+                self.__rings.append((low, high))
+        self.__lat, self.__lng = radians(center[0]), radians(center[1])
+        outer = self.__rings[-1][1]
+        self.__box = None  # Largest change in latitude and longitude of a point inside the outer ring
+        if outer < pi / 2 - abs(self.__lat):  # Doesn't reach over a pole
+            self.__box = (outer, asin(min(1.0, sin(outer) / cos(self.__lat))))
+        self.__approx = abs(self.__lat) <= self._max_lat
+
+    # Returns a DistanceRings for the filters, or None if they allow any distance
+    @staticmethod
+    def create(filters, center):
+        rings = [(filt.min_dist, filt.max_dist) for filt in filters]
+        if len(rings) == 0 or any(low <= 0 and high == float('inf') for low, high in rings):
+            return None
+        return DistanceRings(rings, center)
+
+    # Returns False if the point is certainly outside every ring, True if it is inside or too close to tell
+    def may_contain(self, lat, lng):
+        dlat = radians(lat) - self.__lat
+        dlng = (radians(lng) - self.__lng + pi) % (2 * pi) - pi
+        if self.__box is not None and (abs(dlat) > self.__box[0] or abs(dlng) > self.__box[1]):
+            return False
+        if not self.__approx:
+            return True
+        x = dlng * cos(self.__lat + dlat / 2)
+        dist = sqrt(x * x + dlat * dlat)
+        if dist > self._max_approx:
+            return True
+        margin = dist * self._tolerance + 1e-9
+        for low, high in self.__rings:
+            if dist + margin < low:
+                return False  # Between this ring and the one before it
+            if dist - margin <= high:
+                return True
+        return False  # Past the outer ring
+
+
 class Geofence(object):
 
     # Expects points to be
@@ -361,23 +431,39 @@ class Geofence(object):
             self.__min_y = min(p[1], self.__min_y)
             self.__max_y = max(p[1], self.__max_y)
 
+        # Split the polygon into slabs between the y values of its points, so that a point only has to be checked
+        # against the few edges that cross the slab it is in (edges[k] cross every y in ys[k-1] < y <= ys[k])
+        self.__ys = sorted(set(p[1] for p in points))
+        self.__slabs = [[] for _ in self.__ys]
+        n = len(points)
+        for i in range(n):
+            p1x, p1y = points[i]
+            p2x, p2y = points[(i + 1) % n]
+            if p1y == p2y:
+                continue  # Flat edges never cross a slab
+            edge = (p1x, p1y, p2x - p1x, p2y - p1y, max(p1x, p2x), p1x == p2x)
+            for k in range(bisect_left(self.__ys, min(p1y, p2y)) + 1, bisect_left(self.__ys, max(p1y, p2y)) + 1):
+                self.__slabs[k].append(edge)
+
     def contains(self, x, y):
         # Quick check the boundary box of the entire polygon
         if self.__max_x < x or x < self.__min_x or self.__max_y < y or y < self.__min_y:
             return False
 
+        k = bisect_left(self.__ys, y)
+        if k == 0:
+            return False  # On the lowest point, so below every edge
+        # Count the edges crossed by a ray from the point towards +x
         inside = False
-        p1x, p1y = self.__points[0]
-        n = len(self.__points)
-        for i in range(1, n+1):
-            p2x, p2y = self.__points[i % n]
-            if min(p1y, p2y) < y <= max(p1y, p2y) and x <= max(p1x, p2x):
-                        if p1y != p2y:
-                            xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-                        if p1x == p2x or x <= xinters:
-                            inside = not inside
-            p1x, p1y = p2x, p2y
+        for p1x, p1y, dx, dy, max_x, vertical in self.__slabs[k]:
+            if x <= max_x and (vertical or x <= (y - p1y) * dx / dy + p1x):
+                inside = not inside
         return inside
 
+    # Returns a list of whether each of the points is inside the geofence
+    def contains_many(self, xs, ys):
+        contains = self.contains
+        return [contains(x, y) for x, y in zip(xs, ys)]
+
     def get_name(self):
-        return self.__name
\ No newline at end of file
+        return self.name
\ No newline at end of file
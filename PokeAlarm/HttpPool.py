@@ -0,0 +1,81 @@
+# Standard Library Imports
+import logging
+# 3rd Party Imports
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages import urllib3
+# Local Imports
+from . import config
+from Dispatcher import get_time_left
+
+log = logging.getLogger('HttpPool')
+
+# Connection pools shared by every alarm in the process (created on first use, after the Manager forks)
+_adapter = None
+_session = None
+_pool_managers = []
+
+
+# Returns the configured (connect, read) timeout, for clients that keep it for every request they make
+def get_client_timeout():
+    return config.get('HTTP_CONNECT_TIMEOUT', 3.0), config.get('HTTP_READ_TIMEOUT', 5.0)
+
+
+# Returns the (connect, read) timeout that should be used for requests (never past the notification's deadline)
+def get_timeout():
+    connect, read = get_client_timeout()
+    time_left = get_time_left()
+    if time_left is not None:
+        connect, read = max(0.1, min(connect, time_left)), max(0.1, min(read, time_left))
+    return connect, read
+
+
+# Returns the adapter holding the keep-alive connection pools for each host
+def get_adapter():
+    global _adapter
+    if _adapter is None:
+        size = config.get('HTTP_POOL_SIZE', 10)
+        _adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size, max_retries=0)
+        log.debug("HTTP connection pools created with a size of {}.".format(size))
+    return _adapter
+
+
+# Returns the session that should be used for plain HTTP requests
+def get_session():
+    global _session
+    if _session is None:
+        _session = mount(requests.Session())
+    return _session
+
+
+# Make an existing session (such as one owned by a 3rd party client) use the shared connection pools
+def mount(session):
+    session.mount('http://', get_adapter())
+    session.mount('https://', get_adapter())
+    return session
+
+
+# Returns a urllib3 PoolManager for clients that don't use requests (shares settings and stats with the rest)
+def get_pool_manager():
+    if len(_pool_managers) == 0:
+        size = config.get('HTTP_POOL_SIZE', 10)
+        timeout = urllib3.Timeout(
+            connect=config.get('HTTP_CONNECT_TIMEOUT', 3.0), read=config.get('HTTP_READ_TIMEOUT', 5.0))
+        _pool_managers.append(urllib3.PoolManager(num_pools=size, maxsize=size, retries=False, timeout=timeout))
+    return _pool_managers[0]
+
+
+# Returns the number of requests made and connections opened (each one a TCP/TLS handshake) by the pools
+def get_stats():
+    requests_, connections = 0, 0
+    for manager in [get_adapter().poolmanager] + _pool_managers:
+        for key in manager.pools.keys():
+            pool = manager.pools.get(key)
+            if pool is not None:
+                requests_ += pool.num_requests
+                connections += pool.num_connections
+    return {
+        'requests': requests_,
+        'connections': connections,
+        'reuse_rate': 1.0 - float(connections) / requests_ if requests_ > 0 else 0.0
+    }
@@ -0,0 +1,89 @@
+# Standard Library Imports
+import calendar
+from datetime import datetime
+import json
+import logging
+import os
+# 3rd Party Imports
+# Local Imports
+
+log = logging.getLogger('Journal')
+
+
+# An append-only log of JSON records that can be replayed and compacted
+class Journal(object):
+
+    def __init__(self, path):
+        self.__path = path
+        self.__file = None
+        self.__buffer = []  # Records waiting to be written
+        self.__count = 0  # Number of records in the file
+
+    # Returns the number of records (written or buffered) in the journal
+    def size(self):
+        return self.__count + len(self.__buffer)
+
+    # Queue a record to be written on the next flush
+    def append(self, record):
+        self.__buffer.append(json.dumps(record, default=encode_datetime, separators=(',', ':')))
+
+    # Write any buffered records to the end of the file
+    def flush(self, sync=False):
+        if len(self.__buffer) > 0:
+            if self.__file is None:
+                self.__file = open(self.__path, 'a')
+            self.__file.write('\n'.join(self.__buffer) + '\n')
+            self.__count += len(self.__buffer)
+            self.__buffer = []
+        if self.__file is not None:
+            self.__file.flush()
+            if sync:
+                os.fsync(self.__file.fileno())
+
+    # Returns a list of all the records in the file (a partially written last line is ignored)
+    def replay(self):
+        records = []
+        if not os.path.isfile(self.__path):
+            return records
+        with open(self.__path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line, object_hook=decode_datetime))
+                except ValueError:
+                    log.warning("Skipping unreadable record in {}.".format(self.__path))
+        self.__count = len(records)
+        return records
+
+    # Replace the contents of the file with the given records
+    def rewrite(self, records):
+        self.close()
+        tmp_path = self.__path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record, default=encode_datetime, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.__path)
+        self.__count = len(records)
+        self.__buffer = []
+
+    # Flush and close the underlying file
+    def close(self):
+        self.flush(sync=True)
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+# Used by json.dumps to store datetimes (always UTC in PokeAlarm)
+def encode_datetime(obj):
+    if isinstance(obj, datetime):
+        return {'__utc__': calendar.timegm(obj.utctimetuple()) + obj.microsecond / 1000000.0}
+    raise TypeError("{} is not JSON serializable".format(repr(obj)))
+
+
+# Used by json.loads to restore datetimes written by encode_datetime
+def decode_datetime(obj):
+    if '__utc__' in obj:
+        return datetime.utcfromtimestamp(obj['__utc__'])
+    return obj
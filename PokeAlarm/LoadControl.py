@@ -0,0 +1,66 @@
+# Standard Library Imports
+import logging
+import time
+# 3rd Party Imports
+# Local Imports
+
+log = logging.getLogger('LoadControl')
+
+# Each level skips a little more work to help a Manager that has fallen behind catch back up
+NORMAL, NO_ENRICHMENT, NO_EXTRAS, RAISED_TIME_LIMIT = range(4)
+_level_names = ["normal", "skipping travel info", "skipping extra messages", "raising the time limit"]
+
+_level = NORMAL  # Current level of the Manager in this process (checked by the alarms)
+
+
+# Returns the current load level of this process
+def get_level():
+    return _level
+
+
+# Raises and lowers the load level of a Manager based on how far behind it is
+class LoadController(object):
+
+    _alpha = 0.2  # Weight of each new measurement in the average lag
+    _min_dwell = 10.0  # Seconds to stay at a level before changing again
+    raised_time_limit = 300  # Seconds a pokemon or lure needs left while RAISED_TIME_LIMIT is in effect
+
+    def __init__(self, name, max_lag):
+        self.__name = name
+        self.__max_lag = float(max_lag)  # Average lag (in seconds) that starts the first level, 0 to disable
+        self.__lag = 0.0
+        self.__changed_at = 0
+        self.__transitions = [0] * len(_level_names)  # Number of times each level was entered
+
+    # Update the average lag with a new measurement, changing levels if needed
+    def update(self, lag):
+        if self.__max_lag <= 0:
+            return
+        self.__lag += self._alpha * (lag - self.__lag)
+        if time.time() - self.__changed_at < self._min_dwell:
+            return
+        # Each level starts at a multiple of max_lag, and ends once the lag is back under half of that
+        if _level < RAISED_TIME_LIMIT and self.__lag > self.__max_lag * (_level + 1):
+            self.change_level(_level + 1)
+        elif _level > NORMAL and self.__lag < self.__max_lag * _level / 2.0:
+            self.change_level(_level - 1)
+
+    def change_level(self, level):
+        global _level
+        log.warning("{} is {:.1f}s behind - load level changed from {} ({}) to {} ({}).".format(
+            self.__name, self.__lag, _level, _level_names[_level], level, _level_names[level]))
+        _level = level
+        self.__changed_at = time.time()
+        self.__transitions[level] += 1
+
+    # Returns the minimum time remaining a pokemon or lure needs at the current level
+    def get_time_limit(self, time_limit):
+        return max(time_limit, self.raised_time_limit) if _level >= RAISED_TIME_LIMIT else time_limit
+
+    # Returns a dict of the current level, average lag, and number of times each level was entered
+    def get_stats(self):
+        return {
+            'level': _level,
+            'lag': self.__lag,
+            'transitions': dict(zip(_level_names, self.__transitions))
+        }
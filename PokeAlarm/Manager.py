@@ -1,19 +1,38 @@
 # Standard Library Imports
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import gevent
+import hashlib
 import logging
 import json
 import multiprocessing
 import traceback
 import os
+import Queue
 import re
+import signal
 import sys
+import time
 # 3rd Party Imports
 import gipc
 import googlemaps
 # Local Imports
 from . import config
-from Filters import Geofence, load_pokemon_section, load_pokestop_section, load_gym_section
+import Dedupe
+from Dispatcher import AlarmDispatcher
+from Filters import DistanceRings, Geofence, load_pokemon_section, load_pokestop_section, load_gym_section
+from FilterStats import FilterOrder, FilterStats
+import HttpPool
+import LoadControl
+from LoadControl import LoadController
+import Metrics
+import Profiler
+from QueueLag import LagMonitor
+from Rejections import RejectionLog
+import Retry
+import Trace
+import Watchdog
+from Journal import Journal
 from Utils import get_cardinal_dir, get_dist_as_str, get_earth_dist, get_path, get_time_as_str, \
     require_and_remove_key, parse_boolean, contains_arg
 log = logging.getLogger('Manager')
@@ -21,8 +40,21 @@ log = logging.getLogger('Manager')
 
 class Manager(object):
 
-    def __init__(self, name, google_key, locale, units, timezone, time_limit, location, quiet,
-                 filter_file, geofence_file, alarm_file, debug):
+    _metrics_interval = 5.0  # Seconds between sending metrics to the main process
+    _control_interval = 1.0  # Seconds between checks for requests from the main process
+    # Settings that tell where each type of alarm sends to
+    _alarm_identity_keys = {
+        'discord': ['webhook_url'],
+        'facebook_page': ['page_access_token'],
+        'pushbullet': ['api_key', 'channel'],
+        'slack': ['api_key', 'channel'],
+        'telegram': ['bot_token', 'chat_id'],
+        'twilio': ['account_sid', 'from_number', 'to_number'],
+        'twitter': ['access_token', 'consumer_key']
+    }
+
+    def __init__(self, name, google_key, locale, units, timezone, time_limit, iv_wait, gym_window, max_lag, location,
+                 quiet, filter_file, geofence_file, alarm_file, snapshot_path, debug):
         # Set the name of the Manager
         self.__name = str(name).lower()
         log.info("----------- Manager '{}' is being created.".format(self.__name))
@@ -42,15 +74,36 @@ class Manager(object):
         self.__units = units  # type of unit used for distances
         self.__timezone = timezone  # timezone for time calculations
         self.__time_limit = time_limit  # Minimum time remaining for stops and pokemon
+        self.__iv_wait = iv_wait  # Seconds to hold pokemon without IVs while waiting for them to arrive
+        self.__gym_window = gym_window  # Seconds to collect changes to a gym before sending one notification
+        self.__load = LoadController(self.__name, max_lag)  # Skips optional work when the Manager falls behind
         self.__latlng = self.get_lat_lng_from_name(location)  # Array with Lat, Lng for the Manager
         # Quiet mode
         self.__quiet = quiet
+        # Counts why events were turned away, logging every one only in debug mode
+        self.__rejections = RejectionLog("Manager '{}'".format(self.__name), debug, quiet,
+                                         config.get('REJECTION_SAMPLES', 0), config.get('REJECTION_SUMMARY', 60))
 
         # Load and Setup the Pokemon Filters
         self.__pokemon_settings, self.__pokestop_settings, self.__gym_settings = {}, {}, {}
+        self.__pokemon_rings = {}  # pkmn_id -> distances that at least one of its filters allows
         self.__pokemon_hist, self.__pokestop_hist, self.__gym_hist = {}, {}, {}
+        # Pokemon waiting on their IVs (in order of release) and pokemon that may be upgraded by late IVs
+        self.__pokemon_pending, self.__pokemon_no_iv = OrderedDict(), {}
+        # Gyms with changes waiting to be combined (gym_id -> (release_time, first old team, latest gym))
+        self.__gyms_pending = OrderedDict()
+        self.__max_pending = 5000
+        self.__filter_stats = FilterStats()  # How often each filter is checked and passed
+        # Tries the filters that match most often first (None to always use the order of the file)
+        self.__filter_order = FilterOrder() if config.get('ADAPTIVE_FILTER_ORDER', False) else None
         self.load_filter_file(get_path(filter_file))
 
+        # Snapshot of the histories that is reloaded on restart (opened in the Manager's process)
+        self.__snapshot_path = get_path(snapshot_path) if snapshot_path is not None else None
+        self.__snapshot_file = os.path.join(get_path(snapshot_path), "{}.hist".format(self.__name)) \
+            if snapshot_path is not None else None
+        self.__snapshot = None
+
         # Create the Geofences to filter with from given file
         self.__geofences = []
         log.debug(geofence_file)
@@ -58,10 +111,18 @@ class Manager(object):
             self.load_geofence_file(get_path(geofence_file))
         # Create the alarms to send notifications out with
         self.__alarms = []
+        self.__dispatch_settings = []  # How each alarm's notifications are queued (matches self.__alarms)
+        self.__dispatchers = []
+        self.__watchdog = None
         self.load_alarms_file(get_path(alarm_file))
 
         # Initialize the queue and start the process
         self.__queue = multiprocessing.Queue()
+        self.__queue_lag = LagMonitor("Manager '{}'".format(self.__name))  # Read by the main process too
+        self.__control = multiprocessing.Queue()  # Requests from the main process (such as profiling)
+        self.__replies = multiprocessing.Queue()  # Answers to requests that need them, as (request id, answer)
+        self.__next_request = 0
+        self.__waiting, self.__answers = set(), {}  # Requests still being waited on, and answers not yet claimed
         self.__process = None
 
         log.info("----------- Manager '{}' successfully created.".format(self.__name))
@@ -70,12 +131,55 @@ class Manager(object):
 
     # Update the object into the queue
     def update(self, obj):
-        self.__queue.put(obj)
+        self.__queue.put((time.time(), obj))  # Stamped so that the Manager can tell how far behind it is
 
     # Get the name of this Manager
     def get_name(self):
         return self.__name
 
+    # Returns the number of objects waiting to be processed
+    def get_queue_size(self):
+        return self.__queue.qsize()
+
+    # Returns how long the object at the front of the queue has been waiting, and the average wait
+    def get_queue_lag(self):
+        return self.__queue_lag.get_age(self.__queue.qsize()), self.__queue_lag.get_average()
+
+    # Ask the process to profile itself for the given number of seconds
+    def request_profile(self, mode, seconds):
+        self.__control.put(('profile', mode, seconds))
+
+    # Returns the filter stats of the process as a dict, or None if it doesn't answer in time
+    def request_filter_stats(self, timeout=5.0):
+        self.__next_request += 1
+        request_id = self.__next_request
+        self.__waiting.add(request_id)
+        self.__control.put(('filter_stats', request_id))
+        stop = time.time() + timeout
+        try:
+            # Another request may read this one's answer, so keep checking for it to be handed over
+            while request_id not in self.__answers and time.time() < stop:
+                # Waited on in a thread so that the server can keep going in the meantime
+                reply = gevent.get_hub().threadpool.apply(self.get_reply, (max(0, min(0.25, stop - time.time())),))
+                if reply is not None and reply[0] in self.__waiting:  # Anything else was given up on
+                    self.__answers[reply[0]] = reply[1]
+            return self.__answers.pop(request_id, None)
+        finally:
+            self.__waiting.discard(request_id)
+
+    # Returns the next (request id, answer) from the Manager, or None if there isn't one in time
+    def get_reply(self, timeout):
+        try:
+            return self.__replies.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    # Ask the process to shut down (and save its snapshot)
+    def stop(self):
+        if self.__process is not None and self.__process.is_alive():
+            self.__process.terminate()
+            self.__process.join(timeout=10)
+
     ####################################################################################################################
 
     ################################################## MANAGER LOADING  ################################################
@@ -91,6 +195,12 @@ class Manager(object):
             # Load in the Pokemon Section
             self.__pokemon_settings = load_pokemon_section(
                 require_and_remove_key('pokemon', filters, "Filters file."))
+            self.__pokemon_rings = {}
+            if self.__latlng is not None:
+                for pkmn_id, pkmn_filters in self.__pokemon_settings['filters'].items():
+                    rings = DistanceRings.create(pkmn_filters, self.__latlng)
+                    if rings is not None:  # Skip species with a filter that allows any distance
+                        self.__pokemon_rings[pkmn_id] = rings
 
             # Load in the Pokestop Section
             self.__pokestop_settings = load_pokestop_section(
@@ -116,6 +226,19 @@ class Manager(object):
         log.debug("Stack trace: \n {}".format(traceback.format_exc()))
         sys.exit(1)
 
+    # Returns a name for the alarm that stays the same as long as it sends to the same place (so that an outbox is
+    # only ever replayed to the alarm it was written for, however the alarms file is rearranged)
+    def get_alarm_identity(self, _type, settings):
+        keys = self._alarm_identity_keys.get(_type, [])
+        digest = hashlib.sha1(json.dumps([_type] + [settings.get(key) for key in keys])).hexdigest()[:12]
+        identity = "{}-{}".format(_type, digest)
+        used = [other['identity'] for other in self.__dispatch_settings]
+        count = 1
+        while identity in used:  # Several alarms sending to the same place are told apart by the order they appear in
+            count += 1
+            identity = "{}-{}-{}".format(_type, digest, count)
+        return identity
+
     # Load in a geofence file
     def load_geofence_file(self, file_path):
         try:
@@ -162,9 +285,20 @@ class Manager(object):
                 log.critical("Alarms file must be a list of Alarms objects - [ {...}, {...}, ... {...} ]")
                 sys.exit(1)
             self.__alarms = []
+            self.__dispatch_settings = []
             for alarm in alarm_settings:
                 if parse_boolean(require_and_remove_key('active', alarm, "Alarm objects in Alarms file.")) is True:
                     _type = require_and_remove_key('type', alarm, "Alarm objects in Alarms file.")
+                    self.__dispatch_settings.append({
+                        'concurrency': int(alarm.pop('concurrency', 1)),  # Number of notifications sent at once
+                        'min_remaining': float(alarm.pop('min_remaining', 0)),  # Seconds left to be worth sending
+                        'batch_size': int(alarm.pop('batch_size', 1)),  # Most notifications sent together
+                        'batch_wait': float(alarm.pop('batch_wait', 0)),  # Seconds to wait for a batch to fill
+                        'durable': parse_boolean(alarm.pop('durable', "False")),  # Keep unsent notifications on disk
+                        'identity': self.get_alarm_identity(_type, alarm)  # Names the outbox
+                    })
+                    if self.__dispatch_settings[-1]['durable'] and self.__snapshot_path is None:
+                        log.warning("Durable alarms need a snapshot_path to save to, so their queues will be lost.")
                     self.set_optional_args(str(alarm))
                     if _type == 'discord':
                         from Discord import DiscordAlarm
@@ -254,26 +388,74 @@ class Manager(object):
         if config['DEBUG'] is True:
             logging.getLogger().setLevel(logging.DEBUG)
 
+        # Send this Manager's metrics to the main process every so often
+        Metrics.init_process({'manager': self.__name})
+        gevent.spawn(self.push_metrics)
+        gevent.spawn(self.handle_control)
+        self.__watchdog = Watchdog.start("Manager '{}'".format(self.__name), config.get('BLOCK_THRESHOLD', 0))
+
+        # Restore the histories from the last run and save them again on shutdown
+        self.load_snapshot()
+        signal.signal(signal.SIGTERM, self.handle_shutdown)
+
         # Conect the alarms and send the start up message
         for alarm in self.__alarms:
             alarm.connect()
             alarm.startup_message()
 
+        # Give each alarm its own queue so that slow services don't hold up processing
+        self.__dispatchers = []
+        for alarm, settings in zip(self.__alarms, self.__dispatch_settings):
+            name = "{} #{}".format(type(alarm).__name__, len(self.__dispatchers))
+            outbox = None
+            if settings['durable'] and self.__snapshot_path is not None:
+                outbox = Journal(os.path.join(self.__snapshot_path, "{}.{}.outbox".format(
+                    self.__name, settings['identity'])))
+            dispatcher = AlarmDispatcher(name, alarm, settings['concurrency'], settings['min_remaining'],
+                                         settings['batch_size'], settings['batch_wait'], outbox)
+            dispatcher.start()
+            self.__dispatchers.append(dispatcher)
+
     # Main event handler loop
     def run(self):
         self.setup_in_process()
+        try:
+            self.handle_events()
+        finally:
+            self.save_snapshot()
+            for dispatcher in self.__dispatchers:
+                dispatcher.close()
+
+    def handle_events(self):
         last_clean = datetime.utcnow()
         while True:  # Run forever and ever
-            # Get next object to process
-            obj = self.__queue.get(block=True)
+            # Get next object to process (wake up periodically if pokemon are waiting on their IVs)
+            # The queue is read in a thread so that the alarms can keep sending in the meantime
+            try:
+                queued_at, obj = gevent.get_hub().threadpool.apply(
+                    self.__queue.get,
+                    (True, 1 if len(self.__pokemon_pending) > 0 or len(self.__gyms_pending) > 0 else None))
+                self.__queue_lag.record(queued_at)
+                self.update_load(queued_at)
+                Trace.mark(obj.get('trace'), 'dequeued')
+            except Queue.Empty:
+                obj = None
             # Clean out visited every 3 minutes
             if datetime.utcnow() - last_clean > timedelta(minutes=3):
                 log.debug("Cleaning history...")
                 self.clean_hist()
+                self.update_snapshot()
+                self.log_stats()
                 last_clean = datetime.utcnow()
             try:
+                self.__rejections.summarize()
+                self.release_pending_pokemon()
+                self.release_pending_gyms()
+                if obj is None:
+                    continue
                 kind = obj['type']
                 log.debug("Processing object {} with id {}".format(obj['type'], obj['id']))
+                Metrics.inc('pokealarm_events_processed_total', {'type': kind})
                 if kind == "pokemon":
                     self.process_pokemon(obj)
                 elif kind == "pokestop":
@@ -287,9 +469,74 @@ class Manager(object):
                 log.error("Encountered error during processing: {}: {}".format(type(e).__name__, e))
                 log.debug("Stack trace: \n {}".format(traceback.format_exc()))
 
+    # Let the load controller know how far behind the Manager and its alarms are
+    def update_load(self, queued_at):
+        now = time.time()
+        lag = now - queued_at
+        for dispatcher in self.__dispatchers:
+            lag = max(lag, dispatcher.get_lag(now))
+        self.__load.update(lag)
+
+    # Send this Manager's metrics to the main process until the end of time
+    def push_metrics(self):
+        while True:
+            gevent.sleep(self._metrics_interval)
+            for dispatcher in self.__dispatchers:
+                Metrics.set_gauge('pokealarm_alarm_queue_depth', {'alarm': dispatcher.get_name()},
+                                  dispatcher.get_stats()['queued'])
+            Metrics.push(self.__name)
+
+    # Carry out requests from the main process until the end of time
+    def handle_control(self):
+        while True:
+            gevent.sleep(self._control_interval)
+            while True:  # Answer everything that came in, so that requests made together don't wait on each other
+                try:
+                    request = self.__control.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    if request[0] == 'profile':
+                        Profiler.start(self.__name, request[1], request[2])
+                    elif request[0] == 'filter_stats':
+                        self.__replies.put((request[1], self.get_filter_stats()))
+                    else:
+                        log.error("!!! Manager does not support {} requests!".format(request[0]))
+                except Exception as e:
+                    log.error("Encountered error during {} request: {}: {}".format(request[0], type(e).__name__, e))
+                    log.debug("Stack trace: \n {}".format(traceback.format_exc()))
+
+    # Returns how often each filter was checked, passed, and why it turned events away, along with the time spent
+    # checking each species (filters are numbered as in the filters file)
+    def get_filter_stats(self):
+        pokemon = {}
+        for pkmn_id, filters in self.__pokemon_settings.get('filters', {}).items():
+            counts = self.__filter_stats.get_filters('pokemon', pkmn_id)
+            pokemon[pkmn_id] = dict(self.__filter_stats.get_time(pkmn_id), name=self.__pokemon_name.get(pkmn_id),
+                                    filters=[dict(counts.get(ct, {'evaluated': 0, 'matched': 0, 'rejected': {}}),
+                                                  settings=filters[ct].to_dict()) for ct in range(len(filters))])
+        stats = {'pokemon': pokemon}
+        for kind, settings in (('pokestop', self.__pokestop_settings), ('gym', self.__gym_settings)):
+            filters = settings.get('filters', [])
+            counts = self.__filter_stats.get_filters(kind, None)
+            stats[kind] = [dict(counts.get(ct, {'evaluated': 0, 'matched': 0, 'rejected': {}}),
+                                settings=filters[ct].to_dict()) for ct in range(len(filters))]
+        return stats
+
+    # Count an event that was not sent, by the reason why (the message is only logged now and then)
+    def reject(self, kind, subject, reason, message, *args):
+        Metrics.inc('pokealarm_events_rejected_total', {'type': kind, 'reason': reason})
+        self.__rejections.add(subject, reason, message, *args)
+
+    # Note a filter turning an event away - the event itself is only counted once, by the first check it failed
+    def reject_filter(self, failed, kind, key, filt_ct, check, message, *args):
+        failed.append(check)
+        self.__filter_stats.rejected(kind, key, filt_ct, check)
+        self.__rejections.detail(message, *args)
+
     # Clean out the expired objects from histories (to prevent oversized sets)
     def clean_hist(self):
-        for dict_ in (self.__pokemon_hist, self.__pokestop_hist):
+        for dict_ in (self.__pokemon_hist, self.__pokestop_hist, self.__pokemon_no_iv):
             old = []
             for id_ in dict_:  # Gather old events
                 if dict_[id_] < datetime.utcnow():
@@ -297,41 +544,215 @@ class Manager(object):
             for id_ in old:  # Remove gathered events
                 del dict_[id_]
 
+    # Report how far behind each of the alarms is and how well connections are being reused
+    def log_stats(self):
+        for dispatcher in self.__dispatchers:
+            stats = dispatcher.get_stats()
+            log.info("{}: {} queued, {} in flight, {} sent, {} errors, {} dropped as stale, {} requeued.".format(
+                dispatcher.get_name(), stats['queued'], stats['in_flight'], stats['sent'], stats['errors'],
+                stats['dropped_stale'], stats['requeued']))
+            if len(stats['alarm']) > 0:
+                log.info("{}: {}.".format(dispatcher.get_name(), ", ".join(
+                    "{} {}".format(value, key) for key, value in sorted(stats['alarm'].items()))))
+        stats = HttpPool.get_stats()
+        log.info("HTTP: {} requests over {} connections ({:.1%} reused).".format(
+            stats['requests'], stats['connections'], stats['reuse_rate']))
+        stats = self.__load.get_stats()
+        if stats['level'] > 0 or sum(stats['transitions'].values()) > 0:
+            log.info("Load: level {} with {:.1f}s average lag. Levels entered: {}.".format(
+                stats['level'], stats['lag'], ", ".join(
+                    "{} {}x".format(name, count) for name, count in stats['transitions'].items() if count > 0)))
+        if self.__watchdog is not None and self.__watchdog.get_stats()['blocks'] > 0:
+            stats = self.__watchdog.get_stats()
+            log.info("Hub: blocked {} time(s), longest about {:.2f}s.".format(stats['blocks'], stats['longest']))
+        if Dedupe.get_skipped() > 0:
+            log.info("Dedupe: {} sends skipped because another Manager already made them.".format(
+                Dedupe.get_skipped()))
+        for policy in Retry.get_policies():
+            stats = policy.get_stats()
+            if stats['retries'] > 0 or stats['fast_fails'] > 0 or stats['open_circuits'] > 0:
+                log.info("{}: {} retries taking {:.1f}s, {} skipped, {} circuit(s) open.".format(
+                    policy.name, stats['retries'], stats['retry_time'], stats['fast_fails'], stats['open_circuits']))
+
+    # Hand off the notification to each alarm's queue
+    def dispatch(self, kind, info):
+        Metrics.inc('pokealarm_events_matched_total', {'type': kind})
+        for dispatcher in self.__dispatchers:
+            dispatcher.put(kind, info)
+
+    # Exit the process cleanly when asked to terminate
+    def handle_shutdown(self, signum, frame):
+        log.info("Manager '{}' is shutting down.".format(self.__name))
+        sys.exit(0)
+
+    # Load the histories saved by a previous run
+    def load_snapshot(self):
+        if self.__snapshot_file is None:
+            return
+        start = time.time()
+        if not os.path.isdir(os.path.dirname(self.__snapshot_file)):
+            os.makedirs(os.path.dirname(self.__snapshot_file))
+        self.__snapshot = Journal(self.__snapshot_file)
+        hists = {'pokemon': self.__pokemon_hist, 'pokestop': self.__pokestop_hist, 'gym': self.__gym_hist}
+        try:
+            for kind, id_, value in self.__snapshot.replay():
+                hists[kind][id_] = value
+        except Exception as e:
+            log.error("Encountered error while loading snapshot: {}: {}".format(type(e).__name__, e))
+            log.debug("Stack trace: \n {}".format(traceback.format_exc()))
+        self.clean_hist()
+        log.info("Loaded snapshot of {} pokemon, {} pokestops, and {} gyms in {:.3f}s.".format(
+            len(self.__pokemon_hist), len(self.__pokestop_hist), len(self.__gym_hist), time.time() - start))
+
+    # Record a change to the histories so that it survives a restart
+    def journal_hist(self, kind, id_, value):
+        if self.__snapshot is not None:
+            self.__snapshot.append([kind, id_, value])
+
+    # Write out recent changes, compacting the snapshot once it has grown too much
+    def update_snapshot(self):
+        if self.__snapshot is None:
+            return
+        live = len(self.__pokemon_hist) + len(self.__pokestop_hist) + len(self.__gym_hist)
+        if self.__snapshot.size() > 2 * live + 1000:
+            self.save_snapshot()
+            return
+        start = time.time()
+        self.__snapshot.flush(sync=True)
+        log.debug("Snapshot updated in {:.3f}s.".format(time.time() - start))
+
+    # Write a compact copy of the current histories
+    def save_snapshot(self):
+        if self.__snapshot is None:
+            return
+        start = time.time()
+        records = []
+        for kind, hist in (('pokemon', self.__pokemon_hist), ('pokestop', self.__pokestop_hist),
+                           ('gym', self.__gym_hist)):
+            for id_, value in hist.iteritems():
+                records.append([kind, id_, value])
+        try:
+            self.__snapshot.rewrite(records)
+            log.info("Saved snapshot of {} entries in {:.3f}s.".format(len(records), time.time() - start))
+        except Exception as e:
+            log.error("Encountered error while saving snapshot: {}: {}".format(type(e).__name__, e))
+            log.debug("Stack trace: \n {}".format(traceback.format_exc()))
+
     # Process new Pokemon data and decide if a notification needs to be sent
     def process_pokemon(self, pkmn):
         # Make sure that pokemon are enabled
         if self.__pokemon_settings['enabled'] is False:
-            log.debug("Pokemon ignored: pokemon notifications are disabled.")
+            self.reject('pokemon', "Pokemon", 'disabled', "Pokemon ignored: pokemon notifications are disabled.")
             return
 
         # Extract some base information
         id_ = pkmn['id']
-        pkmn_id = pkmn['pkmn_id']
-        name = self.__pokemon_name[pkmn_id]
+        name = self.__pokemon_name[pkmn['pkmn_id']]
 
         # Check for previously processed
         if id_ in self.__pokemon_hist:
-            log.debug("{} was skipped because it was previously processed.".format(name))
-            return
-        self.__pokemon_hist[id_] = pkmn['disappear_time']
+            if not self.merge_late_iv(pkmn):
+                self.reject('pokemon', name, 'duplicate', "{} was skipped because it was previously processed.", name)
+                return
+        else:
+            self.__pokemon_hist[id_] = pkmn['disappear_time']
+            self.journal_hist('pokemon', id_, pkmn['disappear_time'])
+
+        self.filter_pokemon(pkmn, hold=self.__iv_wait > 0)
+
+    # Check a pokemon against the filters and send out notifications if it passes (or hold it for its IVs)
+    def filter_pokemon(self, pkmn, hold):
+        id_ = pkmn['id']
+        pkmn_id = pkmn['pkmn_id']
+        name = self.__pokemon_name[pkmn_id]
 
         # Check the time remaining
         seconds_left = (pkmn['disappear_time'] - datetime.utcnow()).total_seconds()
-        if seconds_left < self.__time_limit:
-            if self.__quiet is False:
-                log.info("{} ignored: Only {} seconds remaining.".format(name, seconds_left))
+        if seconds_left < self.__load.get_time_limit(self.__time_limit):
+            self.reject('pokemon', name, 'time_limit', "{} ignored: Only {} seconds remaining.", name, seconds_left)
             return
 
         # Check that the filter is even set
         if pkmn_id not in self.__pokemon_settings['filters']:
-            if self.__quiet is False:
-                log.info("{} ignored: no filters are set".format(name))
+            self.reject('pokemon', name, 'no_filters', "{} ignored: no filters are set", name)
             return
 
-        # Extract some useful info that will be used in the filters
-        passed = False
+        # Turn away pokemon too near or far for every filter without working out the exact distance
         lat, lng = pkmn['lat'], pkmn['lng']
+        rings = self.__pokemon_rings.get(pkmn_id)
+        if rings is not None and rings.may_contain(lat, lng) is False:
+            self.reject('pokemon', name, 'dist', "{} rejected: outside the distance range of every filter", name)
+            return
+
+        # Extract some useful info that will be used in the filters
         dist = get_earth_dist([lat, lng], self.__latlng)
+        iv = pkmn['iv']
+        quick_id = pkmn['quick_id']
+        charge_id = pkmn['charge_id']
+
+        filters = self.__pokemon_settings['filters'][pkmn_id]
+        order = self.__filter_order.get(pkmn_id, len(filters)) if self.__filter_order is not None \
+            else range(len(filters))
+        filt_ct = None
+        failed = []  # Checks that turned the pokemon away, in the order they were made
+        start = time.time()
+        if hold and iv == '?':
+            # Only the filters that depend on IVs need to wait for them - check the rest right away
+            waiting = [ct for ct in order if filters[ct].uses_iv()]
+            if len(waiting) > 0:
+                filt_ct = self.check_pokemon_filters(name, pkmn, dist, [ct for ct in order if ct not in waiting],
+                                                     failed)
+                if filt_ct is None:
+                    self.__filter_stats.add_time(pkmn_id, time.time() - start)
+                    self.hold_pokemon(name, pkmn)
+                    return
+        if filt_ct is None:
+            filt_ct = self.check_pokemon_filters(name, pkmn, dist, order, failed)
+        self.__filter_stats.add_time(pkmn_id, time.time() - start)
+        if filt_ct is not None and self.__filter_order is not None:
+            self.__filter_order.matched(pkmn_id, filt_ct)
+
+        # If we didn't pass any filters
+        if filt_ct is None:
+            if iv == '?' and self.__iv_wait > 0:  # Late IVs get one more chance
+                self.__pokemon_no_iv[id_] = pkmn['disappear_time']
+            self.reject('pokemon', name, failed[0] if len(failed) > 0 else 'filters',
+                        "{} rejected: did not pass any filters", name)
+            return
+
+        # Check all the geofences
+        pkmn['geofence'] = self.check_geofences(name, lat, lng)
+        if len(self.__geofences) > 0 and pkmn['geofence'] == 'unknown':
+            self.reject('pokemon', name, 'geofence', "{} rejected: not inside geofence(s)", name)
+            return
+
+        # Finally, add in all the extra crap we waited to calculate until now
+        Trace.mark(pkmn.get('trace'), 'filtered')
+        time_str = get_time_as_str(pkmn['disappear_time'], self.__timezone)
+        pkmn.update({
+            'pkmn': name,
+            "dist": get_dist_as_str(dist) if dist != 'unkn' else 'unkn',
+            'time_left': time_str[0],
+            '12h_time': time_str[1],
+            '24h_time': time_str[2],
+            'dir': get_cardinal_dir([lat, lng], self.__latlng),
+            'iv_0': "{:.0f}".format(iv) if iv != '?' else '?',
+            'iv': "{:.1f}".format(iv) if iv != '?' else '?',
+            'iv_2': "{:.2f}".format(iv) if iv != '?' else '?',
+            'quick_move': self.__move_name.get(quick_id, 'unknown'),
+            'charge_move': self.__move_name.get(charge_id, 'unknown')
+        })
+        self.add_optional_travel_arguments(pkmn)
+        Trace.mark(pkmn.get('trace'), 'enriched')
+
+        if self.__quiet is False:
+            log.info("{} notification has been triggered!".format(name))
+
+        self.dispatch('pokemon', pkmn)
+
+    # Returns the index (as numbered in the filters file) of the first filter in the given order that the pokemon
+    # passes, or None (adding the checks that turned it away to failed)
+    def check_pokemon_filters(self, name, pkmn, dist, filt_cts, failed):
         iv = pkmn['iv']
         def_ = pkmn['def']
         atk = pkmn['atk']
@@ -340,16 +761,17 @@ class Manager(object):
         charge_id = pkmn['charge_id']
         size = pkmn['size']
 
+        pkmn_id = pkmn['pkmn_id']
         filters = self.__pokemon_settings['filters'][pkmn_id]
-        for filt_ct in range(len(filters)):
+        for filt_ct in filt_cts:
             filt = filters[filt_ct]
 
             # Check the distance from the set location
             if dist != 'unkn':
                 if filt.check_dist(dist) is False:
-                    if self.__quiet is False:
-                        log.info("{} rejected: distance ({:.2f}) was not in range {:.2f} to {:.2f} (F #{})".format(
-                            name, dist, filt.min_dist, filt.max_dist, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'dist',
+                                       "{} rejected: distance ({:.2f}) was not in range {:.2f} to {:.2f} (F #{})", name,
+                                       dist, filt.min_dist, filt.max_dist, filt_ct)
                     continue
             else:
                 log.debug("Filter dist was not checked because the manager has no location set.")
@@ -357,181 +779,188 @@ class Manager(object):
             # Check the IV percent of the Pokemon
             if iv != '?':
                 if not filt.check_iv(iv):
-                    if self.__quiet is False:
-                        log.info("{} rejected: IV percent ({:.2f}) not in range {:.2f} to {:.2f} - (F #{})".format(
-                            name, iv, filt.min_iv, filt.max_iv, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'iv',
+                                       "{} rejected: IV percent ({:.2f}) not in range {:.2f} to {:.2f} - (F #{})", name,
+                                       iv, filt.min_iv, filt.max_iv, filt_ct)
                     continue
             else:
                 if filt.ignore_missing is True:
-                    log.info("{} rejected: 'IV' information was missing (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'iv_missing',
+                                       "{} rejected: 'IV' information was missing (F #{})", name, filt_ct)
                     continue
                 log.debug("Pokemon IV percent was not checked because it was missing.")
 
             # Check the Attack IV of the Pokemon
             if atk != '?':
                 if not filt.check_atk(atk):
-                    if self.__quiet is False:
-                        log.info("{} rejected: Attack IV ({}) not in range {} to {} - (F #{})".format(
-                            name, atk, filt.min_atk, filt.max_atk, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'atk',
+                                       "{} rejected: Attack IV ({}) not in range {} to {} - (F #{})", name, atk,
+                                       filt.min_atk, filt.max_atk, filt_ct)
                     continue
             else:
                 if filt.ignore_missing is True:
-                    log.info("{} rejected: Attack IV information was missing - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'atk_missing',
+                                       "{} rejected: Attack IV information was missing - (F #{})", name, filt_ct)
                     continue
                 log.debug("Pokemon 'atk' was not checked because it was missing.")
 
             # Check the Defense IV of the Pokemon
             if def_ != '?':
                 if not filt.check_def(def_):
-                    if self.__quiet is False:
-                        log.info("{} rejected: Defense IV ({}) not in range {} to {} - (F #{})".format(
-                            name, def_, filt.min_atk, filt.max_atk, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'def',
+                                       "{} rejected: Defense IV ({}) not in range {} to {} - (F #{})", name, def_,
+                                       filt.min_atk, filt.max_atk, filt_ct)
                     continue
             else:
                 if filt.ignore_missing is True:
-                    log.info("{} rejected: Defense IV information was missing - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'def_missing',
+                                       "{} rejected: Defense IV information was missing - (F #{})", name, filt_ct)
                     continue
                 log.debug("Pokemon 'def' was not checked because it was missing.")
 
             # Check the Stamina IV of the Pokemon
             if sta != '?':
                 if not filt.check_sta(sta):
-                    if self.__quiet is False:
-                        log.info("{} rejected: Stamina IV ({}) not in range {} to {} - (F #{}).".format(
-                            name, def_, filt.min_sta, filt.max_sta, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'sta',
+                                       "{} rejected: Stamina IV ({}) not in range {} to {} - (F #{}).", name, def_,
+                                       filt.min_sta, filt.max_sta, filt_ct)
                     continue
             else:
                 if filt.ignore_missing is True:
-                    log.info("{} rejected: Stamina IV information was missing - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'sta_missing',
+                                       "{} rejected: Stamina IV information was missing - (F #{})", name, filt_ct)
                     continue
                 log.debug("Pokemon 'sta' was not checked because it was missing.")
 
             # Check the Quick Move of the Pokemon
             if quick_id != '?':
                 if not filt.check_quick_move(quick_id):
-                    if self.__quiet is False:
-                        log.info("{} rejected: Quick move was not correct - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'quick_move',
+                                       "{} rejected: Quick move was not correct - (F #{})", name, filt_ct)
                     continue
             else:
                 if filt.ignore_missing is True:
-                    log.info("{} rejected: Quick move information was missing - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'quick_move_missing',
+                                       "{} rejected: Quick move information was missing - (F #{})", name, filt_ct)
                     continue
                 log.debug("Pokemon 'quick_id' was not checked because it was missing.")
 
             # Check the Quick Move of the Pokemon
             if charge_id != '?':
                 if not filt.check_charge_move(charge_id):
-                    if self.__quiet is False:
-                        log.info("{} rejected: Charge move was not correct - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'charge_move',
+                                       "{} rejected: Charge move was not correct - (F #{})", name, filt_ct)
                     continue
             else:
                 if filt.ignore_missing is True:
-                    log.info("{} rejected: Charge move information was missing - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'charge_move_missing',
+                                       "{} rejected: Charge move information was missing - (F #{})", name, filt_ct)
                     continue
                 log.debug("Pokemon 'charge_id' was not checked because it was missing.")
 
             # Check for a correct move combo
             if quick_id != '?' and charge_id != '?':
                 if not filt.check_moveset(quick_id, charge_id):
-                    if self.__quiet is False:
-                        log.info("{} rejected: Moveset was not correct - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'moveset',
+                                       "{} rejected: Moveset was not correct - (F #{})", name, filt_ct)
                     continue
             else:  # This will probably never happen? but just to be safe...
                 if filt.ignore_missing is True:
-                    log.info("{} rejected: Moveset information was missing - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'moveset_missing',
+                                       "{} rejected: Moveset information was missing - (F #{})", name, filt_ct)
                     continue
                 log.debug("Pokemon 'moveset' was not checked because it was missing.")
 
             # Check for a valid size
             if size != 'unknown':
                 if not filt.check_size(size):
-                    if self.__quiet is False:
-                        log.info("{} rejected: Size ({}) was not correct - (F #{})".format(name, size, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'size',
+                                       "{} rejected: Size ({}) was not correct - (F #{})", name, size, filt_ct)
                     continue
             else:
                 if filt.ignore_missing is True:
-                    log.info("{} rejected: Size information was missing - (F #{})".format(name, filt_ct))
+                    self.reject_filter(failed, 'pokemon', pkmn_id, filt_ct, 'size_missing',
+                                       "{} rejected: Size information was missing - (F #{})", name, filt_ct)
                     continue
                 log.debug("Pokemon 'size' was not checked because it was missing.")
 
             # Nothing left to check, so it must have passed
-            passed = True
             log.debug("{} passed filter #{}".format(name, filt_ct))
-            break
-
-        # If we didn't pass any filters
-        if not passed:
-            return
-
-        # Check all the geofences
-        pkmn['geofence'] = self.check_geofences(name, lat, lng)
-        if len(self.__geofences) > 0 and pkmn['geofence'] == 'unknown':
-            log.info("{} rejected: not inside geofence(s)".format(name))
-            return
-
-        # Finally, add in all the extra crap we waited to calculate until now
-        time_str = get_time_as_str(pkmn['disappear_time'], self.__timezone)
-        pkmn.update({
-            'pkmn': name,
-            "dist": get_dist_as_str(dist) if dist != 'unkn' else 'unkn',
-            'time_left': time_str[0],
-            '12h_time': time_str[1],
-            '24h_time': time_str[2],
-            'dir': get_cardinal_dir([lat, lng], self.__latlng),
-            'iv_0': "{:.0f}".format(iv) if iv != '?' else '?',
-            'iv': "{:.1f}".format(iv) if iv != '?' else '?',
-            'iv_2': "{:.2f}".format(iv) if iv != '?' else '?',
-            'quick_move': self.__move_name.get(quick_id, 'unknown'),
-            'charge_move': self.__move_name.get(charge_id, 'unknown')
-        })
-        self.add_optional_travel_arguments(pkmn)
-
-        if self.__quiet is False:
-            log.info("{} notification has been triggered!".format(name))
-
-        threads = []
-        # Spawn notifications in threads so they can work in background
-        for alarm in self.__alarms:
-            threads.append(gevent.spawn(alarm.pokemon_alert, pkmn))
-            gevent.sleep(0)  # explict context yield
-
-        for thread in threads:
-            thread.join()
+            self.__filter_stats.matched('pokemon', pkmn_id, filt_ct)
+            return filt_ct
+        return None
+
+    # Hold a pokemon until its IVs arrive or the wait runs out
+    def hold_pokemon(self, name, pkmn):
+        if len(self.__pokemon_pending) >= self.__max_pending:  # Make room by giving up on the oldest
+            self.filter_pokemon(self.__pokemon_pending.popitem(last=False)[1][1], hold=False)
+        log.debug("{} is being held for up to {} seconds while waiting on IVs.".format(name, self.__iv_wait))
+        self.__pokemon_pending[pkmn['id']] = (datetime.utcnow() + timedelta(seconds=self.__iv_wait), pkmn)
+
+    # Evaluate any held pokemon whose IVs never arrived
+    def release_pending_pokemon(self):
+        now = datetime.utcnow()
+        while len(self.__pokemon_pending) > 0:
+            id_, (release_time, pkmn) = next(self.__pokemon_pending.iteritems())
+            if release_time > now:
+                break
+            del self.__pokemon_pending[id_]
+            log.debug("IVs for {} did not arrive in time - checking without them.".format(id_))
+            self.filter_pokemon(pkmn, hold=False)
+
+    # Returns true if a previously processed pokemon has brought along IVs that it should be checked again with
+    def merge_late_iv(self, pkmn):
+        if self.__iv_wait <= 0 or pkmn['iv'] == '?':
+            return False
+        id_ = pkmn['id']
+        if id_ in self.__pokemon_pending:  # Still on hold - fill in anything the new sighting is missing
+            held = self.__pokemon_pending.pop(id_)[1]
+            for key in held:
+                if pkmn.get(key) in (None, '?', 'unkn', 'unknown'):
+                    pkmn[key] = held[key]
+            log.debug("IVs for {} arrived while it was being held.".format(id_))
+            return True
+        if self.__pokemon_no_iv.pop(id_, None) is not None:  # Rejected without IVs - upgrade only once
+            log.debug("IVs for {} arrived late - checking it one more time.".format(id_))
+            return True
+        return False
 
     def process_pokestop(self, stop):
         # Make sure that pokemon are enabled
         if self.__pokestop_settings['enabled'] is False:
-            log.debug("Pokestop ignored: pokestop notifications are disabled.")
+            self.reject('pokestop', "Pokestop", 'disabled', "Pokestop ignored: pokestop notifications are disabled.")
             return
 
         id_ = stop['id']
 
         # Check for previously processed
         if id_ in self.__pokestop_hist:
-            log.debug("Pokestop was skipped because it was previously processed.")
+            self.reject('pokestop', "Pokestop", 'duplicate',
+                        "Pokestop was skipped because it was previously processed.")
             return
         self.__pokestop_hist[id_] = stop['expire_time']
+        self.journal_hist('pokestop', id_, stop['expire_time'])
 
         # Check the time remaining
         seconds_left = (stop['expire_time'] - datetime.utcnow()).total_seconds()
-        if seconds_left < self.__time_limit:
-            if self.__quiet is False:
-                log.info("Pokestop ({}) ignored: only {} seconds remaining.".format(id_, seconds_left))
+        if seconds_left < self.__load.get_time_limit(self.__time_limit):
+            self.reject('pokestop', "Pokestop", 'time_limit', "Pokestop ({}) ignored: only {} seconds remaining.",
+                        id_, seconds_left)
             return
 
         # Extract some basic information
         lat, lng = stop['lat'], stop['lng']
         dist = get_earth_dist([lat, lng], self.__latlng)
-        passed = False
+        passed, failed = False, []
         filters = self.__pokestop_settings['filters']
         for filt_ct in range(len(filters)):
             filt = filters[filt_ct]
             # Check the distance from the set location
             if dist != 'unkn':
                 if filt.check_dist(dist) is False:
-                    if self.__quiet is False:
-                        log.info("Pokestop rejected: distance ({:.2f}) was not in range".format(dist) +
-                                 " {:.2f} to {:.2f} (F #{})".format(filt.min_dist, filt.max_dist, filt_ct))
+                    self.reject_filter(failed, 'pokestop', None, filt_ct, 'dist',
+                                       "Pokestop rejected: distance ({:.2f}) was not in range {:.2f} to {:.2f} (F #{})",
+                                       dist, filt.min_dist, filt.max_dist, filt_ct)
                     continue
             else:
                 log.debug("Pokestop dist was not checked because the manager has no location set.")
@@ -539,17 +968,21 @@ class Manager(object):
             # Nothing left to check, so it must have passed
             passed = True
             log.debug("Pokstop passed filter #{}".format(filt_ct))
+            self.__filter_stats.matched('pokestop', None, filt_ct)
             break
 
         if not passed:
+            self.reject('pokestop', "Pokestop", failed[0] if len(failed) > 0 else 'filters',
+                        "Pokestop ({}) rejected: did not pass any filters", id_)
             return
 
         # Check the geofences
         stop['geofence'] = self.check_geofences('Pokestop', lat, lng)
         if len(self.__geofences) > 0 and stop['geofence'] == 'unknown':
-            log.info("Pokestop rejected: not within any specified geofence")
+            self.reject('pokestop', "Pokestop", 'geofence', "Pokestop rejected: not within any specified geofence")
             return
 
+        Trace.mark(stop.get('trace'), 'filtered')
         time_str = get_time_as_str(stop['expire_time'], self.__timezone)
         stop.update({
             "dist": get_dist_as_str(dist),
@@ -559,22 +992,16 @@ class Manager(object):
             'dir': get_cardinal_dir([lat, lng], self.__latlng),
         })
         self.add_optional_travel_arguments(stop)
+        Trace.mark(stop.get('trace'), 'enriched')
 
         if self.__quiet is False:
             log.info("Pokestop ({}) notification has been triggered!".format(id_))
 
-        threads = []
-        # Spawn notifications in threads so they can work in background
-        for alarm in self.__alarms:
-            threads.append(gevent.spawn(alarm.pokestop_alert, stop))
-            gevent.sleep(0)  # explict context yield
-
-        for thread in threads:
-            thread.join()
+        self.dispatch('pokestop', stop)
 
     def process_gym(self, gym):
         if self.__gym_settings['enabled'] is False:
-            log.debug("Gym ignored: notifications are disabled.")
+            self.reject('gym', "Gym", 'disabled', "Gym ignored: notifications are disabled.")
             return
 
         # Extract some basic information
@@ -584,62 +1011,73 @@ class Manager(object):
 
         # Doesn't look like anything to me
         if to_team_id == from_team_id:
-            log.debug("Gym ignored: no change detected")
+            self.reject('gym', "Gym", 'no_change', "Gym ignored: no change detected")
             return
         # Ignore changes to neutral
         if self.__gym_settings['ignore_neutral'] and to_team_id == 0:
-            log.debug("Gym update ignored: changed to neutral")
+            self.reject('gym', "Gym", 'neutral', "Gym update ignored: changed to neutral")
             return
         # Update gym's last known team
         self.__gym_hist[gym_id] = to_team_id
+        self.journal_hist('gym', gym_id, to_team_id)
         # Ignore first time updates
         if from_team_id is None:
-            log.debug("Gym update ignored: first time seeing this gym")
+            self.reject('gym', "Gym", 'first_seen', "Gym update ignored: first time seeing this gym")
             return
 
-        # Get some more info out used to check filters
+        if self.__gym_window > 0:  # Wait to see where the gym ends up before sending anything
+            self.hold_gym(gym, from_team_id)
+            return
+        self.filter_gym(gym, from_team_id, to_team_id)
+
+    # Check the change to the gym against the filters and send a notification if it passes
+    def filter_gym(self, gym, from_team_id, to_team_id):
+        gym_id = gym['id']
         lat, lng = gym['lat'], gym['lng']
         dist = get_earth_dist([lat, lng], self.__latlng)
         cur_team = self.__team_name[to_team_id]
         old_team = self.__team_name[from_team_id]
 
         filters = self.__gym_settings['filters']
-        passed = False
+        passed, failed = False, []
         for filt_ct in range(len(filters)):
             filt = filters[filt_ct]
             # Check the distance from the set location
             if dist != 'unkn':
                 if filt.check_dist(dist) is False:
-                    if self.__quiet is False:
-                        log.info("Gym rejected: distance ({:.2f}) was not in range" +
-                                 " {:.2f} to {:.2f} (F #{})".format(dist, filt.min_dist, filt.max_dist, filt_ct))
+                    self.reject_filter(failed, 'gym', None, filt_ct, 'dist',
+                                       "Gym rejected: distance ({:.2f}) was not in range {:.2f} to {:.2f} (F #{})",
+                                       dist, filt.min_dist, filt.max_dist, filt_ct)
                     continue
             else:
                 log.debug("Pokestop dist was not checked because the manager has no location set.")
 
             # Check the old team
             if filt.check_from_team(from_team_id) is False:
-                if self.__quiet is False:
-                    log.info("Gym rejected: {} as old team is not correct (F #{})".format(old_team, filt_ct))
+                self.reject_filter(failed, 'gym', None, filt_ct, 'from_team',
+                                   "Gym rejected: {} as old team is not correct (F #{})", old_team, filt_ct)
                 continue
             # Check the new team
             if filt.check_to_team(to_team_id) is False:
-                if self.__quiet is False:
-                    log.info("Gym rejected: {} as current team is not correct (F #{})".format(cur_team, filt_ct))
+                self.reject_filter(failed, 'gym', None, filt_ct, 'to_team',
+                                   "Gym rejected: {} as current team is not correct (F #{})", cur_team, filt_ct)
                 continue
 
             # Nothing left to check, so it must have passed
             passed = True
             log.debug("Gym passed filter #{}".format(filt_ct))
+            self.__filter_stats.matched('gym', None, filt_ct)
             break
 
         if not passed:
+            self.reject('gym', "Gym", failed[0] if len(failed) > 0 else 'filters',
+                        "Gym ({}) rejected: did not pass any filters", gym_id)
             return
 
         # Check the geofences
         gym['geofence'] = self.check_geofences('Gym', lat, lng)
         if len(self.__geofences) > 0 and gym['geofence'] == 'unknown':
-            log.info("Gym rejected: not inside geofence(s)")
+            self.reject('gym', "Gym", 'geofence', "Gym rejected: not inside geofence(s)")
             return
 
         # Check if in geofences
@@ -648,12 +1086,12 @@ class Manager(object):
             for gf in self.__geofences:
                 inside |= gf.contains(lat, lng)
             if inside is False:
-                if self.__quiet is False:
-                    log.info("Gym update ignored: located outside geofences.")
+                self.reject('gym', "Gym", 'geofence', "Gym update ignored: located outside geofences.")
                 return
         else:
             log.debug("Gym inside geofences was not checked because no geofences were set.")
 
+        Trace.mark(gym.get('trace'), 'filtered')
         gym.update({
             "dist": get_dist_as_str(dist),
             'dir': get_cardinal_dir([lat, lng], self.__latlng),
@@ -661,18 +1099,37 @@ class Manager(object):
             'old_team': old_team
         })
         self.add_optional_travel_arguments(gym)
+        Trace.mark(gym.get('trace'), 'enriched')
 
         if self.__quiet is False:
             log.info("Gym ({}) notification has been triggered!".format(gym_id))
 
-        threads = []
-        # Spawn notifications in threads so they can work in background
-        for alarm in self.__alarms:
-            threads.append(gevent.spawn(alarm.gym_alert, gym))
-            gevent.sleep(0)  # explict context yield
+        self.dispatch('gym', gym)
 
-        for thread in threads:
-            thread.join()
+    # Hold the gym until its window closes, keeping the team it had before the first change
+    def hold_gym(self, gym, from_team_id):
+        held = self.__gyms_pending.get(gym['id'])
+        if held is not None:
+            self.__gyms_pending[gym['id']] = (held[0], held[1], gym)
+            log.debug("Gym ({}) changed again while being held.".format(gym['id']))
+            return
+        if len(self.__gyms_pending) >= self.__max_pending:  # Make room by sending the oldest
+            id_, (release_time, first_team_id, held_gym) = self.__gyms_pending.popitem(last=False)
+            self.filter_gym(held_gym, first_team_id, held_gym['team_id'])
+        self.__gyms_pending[gym['id']] = (datetime.utcnow() + timedelta(seconds=self.__gym_window), from_team_id, gym)
+
+    # Check the net change of any gyms whose windows have closed
+    def release_pending_gyms(self):
+        now = datetime.utcnow()
+        while len(self.__gyms_pending) > 0:
+            id_, (release_time, first_team_id, gym) = next(self.__gyms_pending.iteritems())
+            if release_time > now:
+                break
+            del self.__gyms_pending[id_]
+            if gym['team_id'] == first_team_id:
+                self.reject('gym', "Gym", 'no_change', "Gym ({}) update ignored: back to its original team.", id_)
+                continue
+            self.filter_gym(gym, first_team_id, gym['team_id'])
 
     # Check to see if a notification is within the given range
     def check_geofences(self, name, lat, lng):
@@ -686,6 +1143,8 @@ class Manager(object):
 
     # Retrieve optional requirements
     def add_optional_travel_arguments(self, info):
+        if LoadControl.get_level() >= LoadControl.NO_ENRICHMENT:
+            return  # Google calls are slow, so they are the first to go when the Manager falls behind
         lat, lng = info['lat'], info['lng']
         if self.__api_req['REVERSE_LOCATION']:
             info.update(**self.reverse_location(lat, lng))
@@ -748,6 +1207,18 @@ class Manager(object):
                       + "Please make sure your location is in the correct format")
             sys.exit(1)
 
+    # Make a call to the Google Maps API, keeping track of how many calls are made and how long they take
+    def call_google(self, api, func, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            Metrics.inc('pokealarm_google_errors_total', {'api': api})
+            raise
+        finally:
+            Metrics.inc('pokealarm_google_calls_total', {'api': api})
+            Metrics.observe('pokealarm_google_seconds', time.time() - start, {'api': api})
+
     # Returns the name of the location based on lat and lng
     def reverse_location(self, lat, lng):
         # Set defaults in case something goes wrong
@@ -760,7 +1231,7 @@ class Manager(object):
             log.error("No Google Maps API key provided - unable to reverse geocode.")
             return details
         try:
-            result = self.__gmaps_client.reverse_geocode((lat, lng))[0]
+            result = self.call_google('reverse_geocode', self.__gmaps_client.reverse_geocode, (lat, lng))[0]
             loc = {}
             for item in result['address_components']:
                 for category in item['types']:
@@ -789,7 +1260,8 @@ class Manager(object):
         origin = "{},{}".format(self.__latlng[0], self.__latlng[1])
         dest = "{},{}".format(lat, lng)
         try:
-            result = self.__gmaps_client.distance_matrix(origin, dest, mode='walking', units=config['UNITS'])
+            result = self.call_google('distance_matrix', self.__gmaps_client.distance_matrix, origin, dest,
+                                      mode='walking', units=config['UNITS'])
             result = result.get('rows')[0].get('elements')[0]
             data['walk_dist'] = result.get('distance').get('text').encode('utf-8')
             data['walk_time'] = result.get('duration').get('text').encode('utf-8')
@@ -807,7 +1279,8 @@ class Manager(object):
         origin = "{},{}".format(self.__latlng[0], self.__latlng[1])
         dest = "{},{}".format(lat, lng)
         try:
-            result = self.__gmaps_client.distance_matrix(origin, dest, mode='bicycling', units=config['UNITS'])
+            result = self.call_google('distance_matrix', self.__gmaps_client.distance_matrix, origin, dest,
+                                      mode='bicycling', units=config['UNITS'])
             result = result.get('rows')[0].get('elements')[0]
             data['bike_dist'] = result.get('distance').get('text').encode('utf-8')
             data['bike_time'] = result.get('duration').get('text').encode('utf-8')
@@ -825,7 +1298,8 @@ class Manager(object):
         origin = "{},{}".format(self.__latlng[0], self.__latlng[1])
         dest = "{},{}".format(lat, lng)
         try:
-            result = self.__gmaps_client.distance_matrix(origin, dest, mode='driving', units=config['UNITS'])
+            result = self.call_google('distance_matrix', self.__gmaps_client.distance_matrix, origin, dest,
+                                      mode='driving', units=config['UNITS'])
             result = result.get('rows')[0].get('elements')[0]
             data['drive_dist'] = result.get('distance').get('text').encode('utf-8')
             data['drive_time'] = result.get('duration').get('text').encode('utf-8')
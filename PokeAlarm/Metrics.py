@@ -0,0 +1,188 @@
+# Standard Library Imports
+import logging
+import multiprocessing
+import Queue
+# 3rd Party Imports
+import gevent
+# Local Imports
+
+log = logging.getLogger('Metrics')
+
+# Counters, gauges, and histograms for this process - (name, labels) -> value or Histogram
+_counters, _gauges, _histograms = {}, {}, {}
+_labels = ()  # Labels added to everything recorded by this process (such as the Manager's name)
+_help = {  # name -> description
+    'pokealarm_webhooks_received_total': "Webhooks received, by type.",
+    'pokealarm_webhook_failures_total': "Webhooks that could not be read or converted.",
+    'pokealarm_ingress_queue_depth': "Webhooks waiting to be handed to the Managers.",
+    'pokealarm_ingress_queue_age_seconds': "How long the oldest waiting webhook has been waiting.",
+    'pokealarm_ingress_queue_wait_seconds': "Average time webhooks wait before being handed to the Managers.",
+    'pokealarm_manager_queue_depth': "Objects waiting to be processed by each Manager.",
+    'pokealarm_manager_queue_age_seconds': "How long the oldest object waiting for each Manager has been waiting.",
+    'pokealarm_manager_queue_wait_seconds': "Average time objects wait before a Manager processes them.",
+    'pokealarm_events_processed_total': "Objects processed by each Manager, by type.",
+    'pokealarm_events_rejected_total': "Objects that did not trigger a notification, by reason.",
+    'pokealarm_events_matched_total': "Objects that triggered a notification, by type.",
+    'pokealarm_alarm_queue_depth': "Notifications waiting to be sent by each alarm.",
+    'pokealarm_alarm_sends_total': "Notifications sent by each alarm.",
+    'pokealarm_alarm_failures_total': "Notifications each alarm could not send.",
+    'pokealarm_alarm_stale_total': "Notifications each alarm dropped because they would arrive too late.",
+    'pokealarm_alarm_retries_total': "Retries made by each service.",
+    'pokealarm_alarm_send_seconds': "Time taken to send notifications.",
+    'pokealarm_google_calls_total': "Calls made to the Google Maps API.",
+    'pokealarm_google_errors_total': "Calls to the Google Maps API that failed.",
+    'pokealarm_google_seconds': "Time taken by calls to the Google Maps API.",
+    'pokealarm_stage_seconds': "Time taken to reach each stage from the one before it.",
+    'pokealarm_event_latency_seconds': "Time from receiving a webhook to sending its notification.",
+    'pokealarm_hub_blocks_total': "Times a greenlet kept the gevent hub from switching for too long.",
+    'pokealarm_hub_block_seconds': "How long the gevent hub was kept from switching."
+}
+
+# Carry snapshots from each Manager to the main process (created before the Managers are started)
+_channels = {}  # source -> queue holding at most one snapshot
+_collect_interval = 1.0  # Seconds between reads of the channels by the main process
+_remote = {}  # Latest snapshot from each Manager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# Counts observations into buckets (cumulative, like Prometheus expects)
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i in range(len(self.buckets) - 1, -1, -1):  # Most observations are small, so start from the top
+            if value > self.buckets[i]:
+                break
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Set a description to show for the metric
+def describe(name, text):
+    _help[name] = text
+
+
+# Start recording for a new process, with labels added to everything it records (drops anything from the parent)
+def init_process(labels):
+    global _labels
+    _labels = tuple(sorted(labels.items()))
+    for values in (_counters, _gauges, _histograms, _remote):
+        values.clear()
+
+
+# Returns the key used to store the metric
+def make_key(name, labels):
+    return name, _labels + tuple(sorted(labels.items())) if labels else _labels
+
+
+def inc(name, labels=None, value=1):
+    key = make_key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, labels, value):
+    _gauges[make_key(name, labels)] = value
+
+
+def observe(name, value, labels=None, buckets=DEFAULT_BUCKETS):
+    key = make_key(name, labels)
+    hist = _histograms.get(key)
+    if hist is None:
+        hist = _histograms[key] = Histogram(buckets)
+    hist.observe(value)
+
+
+# Returns everything recorded by this process in a form that can be sent to another process
+def get_snapshot():
+    return {
+        'counters': dict(_counters),
+        'gauges': dict(_gauges),
+        'histograms': dict((key, (h.buckets, list(h.counts), h.sum, h.count)) for key, h in _histograms.items())
+    }
+
+
+# Create the channel a Manager sends its snapshots over (must be called before the Manager is started)
+def create_channel(source):
+    # Only one snapshot is ever waiting, so a main process that falls behind can't fill up the pipe (writes to a full
+    # pipe would block the Manager's whole event loop)
+    _channels[source] = multiprocessing.Queue(maxsize=1)
+
+
+# Send a snapshot of this process's metrics to the main process (skipped until the last one has been read)
+def push(source):
+    channel = _channels.get(source)
+    if channel is None:
+        return
+    try:
+        channel.put_nowait(get_snapshot())
+    except Queue.Full:
+        log.debug("Last metrics update has not been read yet, skipping this one.")
+
+
+# Collect any snapshots sent by the Managers
+def collect():
+    for source, channel in _channels.items():
+        try:
+            _remote[source] = channel.get_nowait()
+        except Queue.Empty:
+            pass
+
+
+# Keep reading the channels in the main process, so that every Manager can always send its next snapshot
+def start_collector():
+    gevent.spawn(run_collector)
+
+
+def run_collector():
+    while True:
+        gevent.sleep(_collect_interval)
+        try:
+            collect()
+        except Exception as e:
+            log.error("Encountered error while collecting metrics: {}: {}".format(type(e).__name__, e))
+
+
+# Returns every metric (from this process and the latest from each Manager) in the Prometheus text format
+def render():
+    collect()
+    snapshots = [get_snapshot()] + [_remote[source] for source in sorted(_remote)]
+    families = {}  # name -> (type, list of lines)
+    for snapshot in snapshots:
+        for kind, values in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+            for (name, labels), value in sorted(values.items()):
+                families.setdefault(name, (kind, []))[1].append(
+                    u"{}{} {}".format(name, format_labels(labels), format_value(value)))
+        for (name, labels), (buckets, counts, sum_, count) in sorted(snapshot['histograms'].items()):
+            lines = families.setdefault(name, ('histogram', []))[1]
+            for bucket, bucket_count in zip(buckets, counts):
+                lines.append(u"{}_bucket{} {}".format(
+                    name, format_labels(labels + (('le', format_value(bucket)),)), bucket_count))
+            lines.append(u"{}_bucket{} {}".format(name, format_labels(labels + (('le', '+Inf'),)), count))
+            lines.append(u"{}_sum{} {}".format(name, format_labels(labels), format_value(sum_)))
+            lines.append(u"{}_count{} {}".format(name, format_labels(labels), count))
+    output = []
+    for name in sorted(families):
+        kind, lines = families[name]
+        if name in _help:
+            output.append(u"# HELP {} {}".format(name, _help[name]))
+        output.append(u"# TYPE {} {}".format(name, kind))
+        output.extend(lines)
+    return u"\n".join(output) + u"\n"
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return u""
+    return u"{" + u",".join(u'{}="{}"'.format(key, unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n')) for key, value in labels) + u"}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
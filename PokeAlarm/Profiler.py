@@ -0,0 +1,113 @@
+# Standard Library Imports
+import cProfile
+from datetime import datetime
+import logging
+import os
+import signal
+import time
+import traceback
+# 3rd Party Imports
+import gevent
+# Local Imports
+from . import config
+
+log = logging.getLogger('Profiler')
+
+MODES = ['sample', 'cprofile']
+MAX_SECONDS = 300
+
+_running = False  # Only one profile at a time in each process
+
+
+# Raised when a profile can't be started
+class ProfileError(Exception):
+    pass
+
+
+# Records where a process is spending its CPU time by looking at the stack every few milliseconds
+class SamplingProfiler(object):
+
+    def __init__(self, interval=0.005):
+        self.__interval = interval  # Seconds of CPU time between samples
+        self.__stacks = {}  # collapsed stack -> number of samples
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.siginterrupt(signal.SIGPROF, False)  # Restart system calls instead of failing them
+        signal.setitimer(signal.ITIMER_PROF, self.__interval, self.__interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+    # Called by the timer with the frame that was running
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        self.__stacks[key] = self.__stacks.get(key, 0) + 1
+
+    # Write the samples as collapsed stacks (one 'outer;inner count' line each, as read by flamegraph.pl)
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.__stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+        return sum(self.__stacks.values())
+
+
+# Raise a ProfileError if a profile can't be made with the given settings
+def check_settings(mode, seconds):
+    if config.get('PROFILE_PATH') is None:
+        raise ProfileError("no profile_path is set")
+    if mode not in MODES:
+        raise ProfileError("mode must be one of {}".format(", ".join(MODES)))
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ProfileError("seconds must be between 0 and {}".format(MAX_SECONDS))
+
+
+# Start profiling this process for the given number of seconds, returns the file the profile will be written to
+def start(name, mode, seconds):
+    global _running
+    check_settings(mode, seconds)
+    folder = config['PROFILE_PATH']
+    if _running:
+        raise ProfileError("a profile is already running in {}".format(name))
+    _running = True
+    path = os.path.join(folder, "{}.{}.{}".format(
+        name, datetime.now().strftime('%Y%m%d-%H%M%S'), 'folded' if mode == 'sample' else 'pstats'))
+    gevent.spawn(run, name, mode, seconds, path)
+    return path
+
+
+def run(name, mode, seconds, path):
+    global _running
+    log.info("Profiling {} ({}) for {}s.".format(name, mode, seconds))
+    start_time = time.time()
+    try:
+        if mode == 'sample':
+            profiler = SamplingProfiler()
+            profiler.start()
+            try:
+                gevent.sleep(seconds)
+            finally:
+                profiler.stop()
+            samples = profiler.write(path)
+            log.info("Profile of {} written to {} ({} samples).".format(name, path, samples))
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                gevent.sleep(seconds)
+            finally:
+                profiler.disable()
+            profiler.dump_stats(path)
+            log.info("Profile of {} written to {}.".format(name, path))
+    except Exception as e:
+        log.error("Encountered error while profiling {} after {:.1f}s: {}: {}".format(
+            name, time.time() - start_time, type(e).__name__, e))
+        log.debug("Stack trace: \n {}".format(traceback.format_exc()))
+    finally:
+        _running = False
@@ -4,6 +4,8 @@ import logging
 from pushbullet import PushBullet
 # Local Imports
 from ..Alarm import Alarm
+from ..Retry import RetryPolicy
+from ..HttpPool import mount
 from ..Utils import parse_boolean, require_and_remove_key, reject_leftover_parameters
 
 log = logging.getLogger(__name__)
@@ -46,6 +48,7 @@ class PushbulletAlarm(Alarm):
 
         # Optional Alarm Parameters
         self.__startup_message = parse_boolean(settings.pop('startup_message', "True"))
+        self.__retry = RetryPolicy('Pushbullet', settings.pop('retry', {}))  # How to handle failed messages
         self.__channel = settings.pop('channel', "True")
         self.__sender = None
 
@@ -62,6 +65,7 @@ class PushbulletAlarm(Alarm):
     # Establish connection with Pushbullet
     def connect(self):
         self.__client = PushBullet(self.__api_key)
+        mount(self.__client._session)  # Keep the client's auth, but share the connection pools
         self.__sender = self.get_sender(self.__channel)
         self.__pokemon['sender'] = self.get_sender(self.__pokemon['channel'])
         self.__pokestop['sender'] = self.get_sender(self.__pokestop['channel'])
@@ -74,7 +78,7 @@ class PushbulletAlarm(Alarm):
                 "title": "PokeAlarm activated!",
                 "message": "PokeAlarm has successully started!"
             }
-            try_sending(log, self.connect, "PushBullet", self.push_note, args)
+            try_sending(log, self.connect, "PushBullet", self.push_note, args, self.__retry)
             log.info("Startup message sent!")
 
     # Set the appropriate settings for each alert
@@ -96,7 +100,7 @@ class PushbulletAlarm(Alarm):
             'url': replace(alert['url'], info),
             'body': replace(alert['body'], info)
         }
-        try_sending(log, self.connect, "PushBullet", self.push_link, args)
+        try_sending(log, self.connect, "PushBullet", self.push_link, args, self.__retry)
 
     # Trigger an alert based on Pokemon info
     def pokemon_alert(self, pokemon_info):
@@ -0,0 +1,44 @@
+# Standard Library Imports
+import logging
+import multiprocessing
+import time
+# 3rd Party Imports
+# Local Imports
+from . import config
+
+log = logging.getLogger('QueueLag')
+
+
+# Tracks how long items wait in a queue, in shared memory so that other processes can read it without locking
+class LagMonitor(object):
+
+    _alpha = 0.2  # Weight of each new measurement in the average wait
+    _warn_interval = 60.0  # Seconds between warnings about the same queue
+
+    def __init__(self, name):
+        self.__name = name
+        # [when the last item taken off was queued, average wait] - only written by the process reading the queue
+        self.__shared = multiprocessing.RawArray('d', 2)
+        self.__warned_at = 0.0
+
+    # Record an item being taken off the queue, warning if it waited too long
+    def record(self, queued_at, now=None):
+        now = now or time.time()
+        wait = now - queued_at
+        self.__shared[0] = queued_at
+        self.__shared[1] += self._alpha * (wait - self.__shared[1])
+        threshold = config.get('QUEUE_AGE_WARNING', 5.0)
+        if 0 < threshold < wait and now - self.__warned_at > self._warn_interval:
+            self.__warned_at = now
+            log.warning("{} is {:.1f}s behind ({:.1f}s on average)... this may be causing a delay in notifications."
+                        .format(self.__name, wait, self.__shared[1]))
+
+    # Returns how long the item at the front of the queue has been waiting (at most, it was queued after the last one)
+    def get_age(self, queue_size, now=None):
+        if queue_size == 0 or self.__shared[0] == 0:
+            return 0.0
+        return max(0.0, (now or time.time()) - self.__shared[0])
+
+    # Returns the average time items have waited in the queue
+    def get_average(self):
+        return self.__shared[1]
@@ -0,0 +1,82 @@
+# Standard Library Imports
+import logging
+import time
+# 3rd Party Imports
+import gevent
+# Local Imports
+
+log = logging.getLogger('RateLimit')
+
+# Buckets for each destination (kept per process)
+_buckets = {}
+
+
+# Raised when a service refuses a request because too many were sent
+class RateLimitError(Exception):
+
+    def __init__(self, message, retry_after):
+        super(RateLimitError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+# Hands out tokens at a steady rate, pausing completely when a service says to back off
+class TokenBucket(object):
+
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.__rate = float(rate)  # Tokens added per second
+        self.__capacity = float(capacity)  # Max tokens that can be saved up (burst size)
+        self.__tokens = self.__capacity
+        self.__last = time.time()
+        self.__paused_until = 0
+
+    # Add any tokens earned since the last update
+    def refill(self):
+        now = time.time()
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__last) * self.__rate)
+        self.__last = now
+        return now
+
+    # Wait until a token is available and take it. Returns the number of seconds spent waiting.
+    def acquire(self):
+        waited = 0.0
+        while True:
+            now = self.refill()
+            if now < self.__paused_until:
+                delay = self.__paused_until - now
+            elif self.__tokens >= 1:
+                self.__tokens -= 1
+                if waited > 0:
+                    log.debug("Waited {:.2f}s for the rate limit of {}.".format(waited, self.name))
+                return waited
+            else:
+                delay = (1 - self.__tokens) / self.__rate
+            gevent.sleep(delay)
+            waited += delay
+
+    # Stop handing out tokens for the given number of seconds
+    def pause(self, seconds):
+        self.refill()
+        self.__tokens = 0
+        self.__paused_until = max(self.__paused_until, time.time() + seconds)
+        log.debug("Holding {} for {:.2f}s to respect its rate limit.".format(self.name, seconds))
+
+    # Adjust the bucket to match the limits reported by the service
+    def update(self, limit=None, remaining=None, reset_after=None):
+        self.refill()
+        if limit is not None and limit > 0:
+            self.__capacity = float(limit)
+            if reset_after is not None and remaining is not None and remaining == limit - 1 and reset_after > 0:
+                self.__rate = limit / reset_after  # A fresh window tells us how fast it refills
+        if remaining is not None:
+            self.__tokens = min(self.__tokens, float(remaining))
+            if remaining <= 0 and reset_after is not None:
+                self.pause(reset_after)
+
+
+# Returns the bucket for the given destination, creating it with the given defaults if needed
+def get_bucket(key, name, rate, capacity):
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _buckets[key] = TokenBucket(name, rate, capacity)
+    return bucket
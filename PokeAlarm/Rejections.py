@@ -0,0 +1,63 @@
+# Standard Library Imports
+import logging
+import time
+# 3rd Party Imports
+# Local Imports
+
+log = logging.getLogger('Rejections')
+
+
+# Counts why events were turned away and logs a summary now and then, instead of a line for every event
+class RejectionLog(object):
+
+    _max_subjects = 10  # Most species (or kinds) listed in each summary
+
+    def __init__(self, name, verbose, quiet, samples_per_minute, summary_interval):
+        self.__name = name
+        self.__verbose = verbose  # Log every rejection (debug mode)
+        self.__quiet = quiet  # No sampled lines or summaries
+        self.__sample_gap = 60.0 / samples_per_minute if samples_per_minute > 0 else None
+        self.__next_sample = 0.0
+        self.__summary_interval = summary_interval
+        self.__counts = {}  # (subject, reason) -> rejections since the last summary
+        self.__since = time.time()
+
+    # Count a rejection - the message is only formatted if it is going to be logged
+    def add(self, subject, reason, message, *args):
+        key = (subject, reason)
+        self.__counts[key] = self.__counts.get(key, 0) + 1
+        if self.__verbose:
+            log.info(message.format(*args))
+        elif self.__sample_gap is not None and not self.__quiet:
+            now = time.time()
+            if now >= self.__next_sample:
+                self.__next_sample = now + self.__sample_gap
+                log.info(message.format(*args) + " (sampled)")
+
+    # Log why a single filter turned an event away (debug mode only - the event is counted once through add)
+    def detail(self, message, *args):
+        if self.__verbose:
+            log.info(message.format(*args))
+
+    # Log a summary of the rejections since the last one if it is time to
+    def summarize(self, now=None):
+        now = now or time.time()
+        if now - self.__since < self.__summary_interval:
+            return
+        counts, since = self.__counts, self.__since
+        self.__counts, self.__since = {}, now
+        if self.__quiet or len(counts) == 0:
+            return
+        subjects = {}  # subject -> (total, {reason -> count})
+        for (subject, reason), count in counts.items():
+            total, reasons = subjects.get(subject, (0, {}))
+            reasons[reason] = count
+            subjects[subject] = (total + count, reasons)
+        ranked = sorted(subjects.items(), key=lambda item: item[1][0], reverse=True)
+        parts = ["{} {} ({})".format(subject, total, ", ".join(
+            "{} {}".format(reason, count) for reason, count in sorted(reasons.items(), key=lambda r: -r[1])))
+            for subject, (total, reasons) in ranked[:self._max_subjects]]
+        if len(ranked) > self._max_subjects:
+            parts.append("+{} more".format(len(ranked) - self._max_subjects))
+        log.info("{}: {} rejections in the last {:.0f}s: {}.".format(
+            self.__name, sum(counts.values()), now - since, "; ".join(parts)))
@@ -0,0 +1,110 @@
+# Standard Library Imports
+import logging
+import random
+import time
+# 3rd Party Imports
+# Local Imports
+from Utils import reject_leftover_parameters
+
+log = logging.getLogger('Retry')
+
+# Every policy created in this process (used for reporting)
+_policies = []
+
+
+# Stops sending to an endpoint after repeated failures, letting a single probe through every so often
+class CircuitBreaker(object):
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.state = CircuitBreaker.CLOSED
+        self.__threshold = threshold  # Consecutive failures before opening
+        self.__reset_timeout = reset_timeout  # Seconds to wait before probing an open endpoint
+        self.__failures = 0
+        self.__opened_at = 0
+        self.__probing = False
+        self.__probe_started = 0  # When the current probe was let through
+
+    # Returns true if a request should be attempted
+    def allow(self):
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        if self.state == CircuitBreaker.OPEN and time.time() - self.__opened_at >= self.__reset_timeout:
+            self.change_state(CircuitBreaker.HALF_OPEN)
+        # A probe that never reported back (gave up or was cut short) doesn't keep the circuit from recovering
+        if self.__probing and time.time() - self.__probe_started >= self.__reset_timeout:
+            self.__probing = False
+        if self.state == CircuitBreaker.HALF_OPEN and not self.__probing:
+            self.__probing = True  # Only one request gets to find out if the endpoint is back
+            self.__probe_started = time.time()
+            return True
+        return False
+
+    def record_success(self):
+        self.__failures = 0
+        self.__probing = False
+        if self.state != CircuitBreaker.CLOSED:
+            self.change_state(CircuitBreaker.CLOSED)
+
+    # Give up the probe without a verdict (the send ended for reasons that say nothing about the endpoint)
+    def release_probe(self):
+        self.__probing = False
+
+    def record_failure(self):
+        self.__failures += 1
+        self.__probing = False
+        if self.state == CircuitBreaker.HALF_OPEN or \
+                (self.state == CircuitBreaker.CLOSED and self.__failures >= self.__threshold):
+            self.__opened_at = time.time()
+            self.change_state(CircuitBreaker.OPEN)
+
+    def change_state(self, state):
+        log.warning("Circuit for {} changed from {} to {}.".format(self.name, self.state, state))
+        self.state = state
+
+
+# Decides how long to wait between attempts and when to give up, and keeps a circuit breaker per endpoint
+class RetryPolicy(object):
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.max_attempts = int(settings.pop('max_attempts', 3))
+        self.base_delay = float(settings.pop('base_delay', 1.0))  # Seconds before the first retry
+        self.max_delay = float(settings.pop('max_delay', 30.0))  # Longest wait between two attempts
+        self.max_elapsed = float(settings.pop('max_elapsed', 60.0))  # Longest time spent on one message
+        self.__breaker_threshold = int(settings.pop('breaker_threshold', 5))
+        self.__breaker_reset = float(settings.pop('breaker_reset', 60.0))
+        reject_leftover_parameters(settings, "'retry' settings of {} alarm.".format(name))
+
+        self.__breakers = {}
+        self.retries, self.retry_time, self.fast_fails = 0, 0.0, 0
+        _policies.append(self)
+
+    # Returns the circuit breaker for the given endpoint
+    def get_breaker(self, endpoint):
+        breaker = self.__breakers.get(endpoint)
+        if breaker is None:
+            breaker = self.__breakers[endpoint] = CircuitBreaker(
+                "{} ({})".format(self.name, len(self.__breakers)), self.__breaker_threshold, self.__breaker_reset)
+        return breaker
+
+    # Returns the seconds to wait before the given retry (exponential, with the upper half randomized)
+    def get_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    # Returns a dict of counts for reporting
+    def get_stats(self):
+        return {
+            'retries': self.retries,
+            'retry_time': self.retry_time,
+            'fast_fails': self.fast_fails,
+            'open_circuits': len([b for b in self.__breakers.values() if b.state != CircuitBreaker.CLOSED])
+        }
+
+
+# Returns the policies created in this process
+def get_policies():
+    return list(_policies)
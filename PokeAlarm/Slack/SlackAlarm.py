@@ -5,6 +5,9 @@ import re
 from slacker import Slacker
 # Local Imports
 from ..Alarm import Alarm
+from .. import LoadControl
+from ..Retry import RetryPolicy
+from ..HttpPool import get_client_timeout, get_session
 from ..Utils import parse_boolean, get_static_map_url, require_and_remove_key, reject_leftover_parameters
 
 log = logging.getLogger('Slack')
@@ -21,6 +24,8 @@ replace = Alarm.replace
 
 class SlackAlarm(Alarm):
 
+    _max_attachments = 20  # Most attachments Slack will show for a single message
+
     _defaults = {
         'pokemon': {
             'username': "<pkmn>",
@@ -56,6 +61,7 @@ class SlackAlarm(Alarm):
 
         # Optional Alarm Parameters
         self.__startup_message = parse_boolean(settings.pop('startup_message', "True"))
+        self.__retry = RetryPolicy('Slack', settings.pop('retry', {}))  # How to handle failed messages
         self.__map = settings.pop('map', {})
         self.__static_map_key = static_map_key
 
@@ -71,7 +77,8 @@ class SlackAlarm(Alarm):
 
     # Establish connection with Slack
     def connect(self):
-        self.__client = Slacker(self.__api_key)
+        # The client keeps its timeout, so the deadline of each message is left to try_sending
+        self.__client = Slacker(self.__api_key, timeout=get_client_timeout(), session=get_session())
         self.update_channels()
 
     # Send a message letting the channel know that this alarm started
@@ -99,7 +106,7 @@ class SlackAlarm(Alarm):
         attachments = [{
             'fallback': 'Map_Preview',
             'image_url': replace( alert['map'], {'lat': info['lat'], 'lng':info['lng']})
-        }] if alert['map'] is not None else None
+        }] if alert['map'] is not None and LoadControl.get_level() < LoadControl.NO_EXTRAS else None
         self.send_message(
             channel=replace(alert['channel'], info),
             username=replace(alert['username'], info),
@@ -109,6 +116,44 @@ class SlackAlarm(Alarm):
             attachments=attachments
         )
 
+    # Send Alerts for several events at once, as an attachment for each in a message per channel
+    def send_batch(self, kind, events):
+        alert = {'pokemon': self.__pokemon, 'pokestop': self.__pokestop, 'gym': self.__gym}[kind]
+        channels, order = {}, []
+        for info in events:
+            channel = replace(alert['channel'], info)
+            if channel not in channels:
+                channels[channel] = []
+                order.append(channel)
+            channels[channel].append(info)
+        for channel in order:
+            infos = channels[channel]
+            for i in range(0, len(infos), self._max_attachments):
+                chunk = infos[i:i + self._max_attachments]
+                usernames = set(replace(alert['username'], info) for info in chunk)
+                icon_urls = set(replace(alert['icon_url'], info) for info in chunk)
+                self.send_message(
+                    channel=channel,
+                    username=usernames.pop() if len(usernames) == 1 else "PokeAlarm",
+                    text='',
+                    icon_url=icon_urls.pop() if len(icon_urls) == 1 else None,
+                    attachments=[self.create_attachment(alert, info) for info in chunk]
+                )
+
+    # Returns an attachment describing the event (used when several are sent in one message)
+    def create_attachment(self, alert, info):
+        attachment = {
+            'fallback': '{} - {}'.format(replace(alert['title'], info), replace(alert['body'], info)),
+            'author_name': replace(alert['username'], info),
+            'author_icon': replace(alert['icon_url'], info),
+            'title': replace(alert['title'], info),
+            'title_link': replace(alert['url'], info),
+            'text': replace(alert['body'], info)
+        }
+        if alert['map'] is not None and LoadControl.get_level() < LoadControl.NO_EXTRAS:
+            attachment['image_url'] = replace(alert['map'], {'lat': info['lat'], 'lng': info['lng']})
+        return attachment
+
     # Trigger an alert based on Pokemon info
     def pokemon_alert(self, pokemon_info):
         self.send_alert(self.__pokemon, pokemon_info)
@@ -152,7 +197,8 @@ class SlackAlarm(Alarm):
             args['icon_url'] = icon_url
         if attachments is not None:
             args['attachments'] = attachments
-        try_sending(log, self.connect, "Slack", self.__client.chat.post_message, args)
+        try_sending(log, self.connect, "Slack", self.__client.chat.post_message, args, self.__retry,
+                    (self.__api_key, args['channel']))  # Channel names are only unique within a workspace
 
     # Returns a string s that is in proper channel format
     @staticmethod
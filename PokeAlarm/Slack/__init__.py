@@ -1,8 +1,30 @@
+import logging
+import sys
+
+
+# Returns true if the installed slacker can share connections (0.9.60 and up)
+def slacker_is_current(slacker):
+    return 'session' in slacker.Slacker.__init__.__code__.co_varnames
+
+
 try:
     import slacker
+    if not slacker_is_current(slacker):
+        raise ImportError
 except ImportError:
     from ..Utils import pip_install
 
-    pip_install('slacker', '0.9.24')
+    pip_install('slacker', '0.9.60')
+    try:
+        if 'slacker' in sys.modules:  # The old version was already loaded, so load the new one in its place
+            slacker = reload(sys.modules['slacker'])
+        else:
+            import slacker
+    except ImportError:
+        slacker = None
+    if slacker is None or not slacker_is_current(slacker):
+        logging.getLogger('Slack').critical(
+            "Slack alarms need slacker 0.9.60 or newer. Please run 'pip install slacker==0.9.60' and restart.")
+        sys.exit(1)
 
 from SlackAlarm import SlackAlarm
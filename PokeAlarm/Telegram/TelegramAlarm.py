@@ -1,9 +1,14 @@
 # Standard Library Imports
 import logging
 # 3rd Party Imports
+from gevent.lock import Semaphore
 import telepot
 # Local Imports
 from ..Alarm import Alarm
+from .. import LoadControl
+from ..Retry import RetryPolicy
+from ..HttpPool import get_pool_manager
+from ..RateLimit import RateLimitError, get_bucket
 from Stickers import sticker_list
 from ..Utils import parse_boolean, require_and_remove_key, reject_leftover_parameters
 
@@ -21,6 +26,8 @@ replace = Alarm.replace
 
 class TelegramAlarm(Alarm):
 
+    _max_length = 4096  # Longest message Telegram will accept
+
     _defaults = {
         'pokemon': {
             # 'chat_id': If no default, required
@@ -45,6 +52,7 @@ class TelegramAlarm(Alarm):
         self.__bot_token = require_and_remove_key('bot_token', settings, "'Telegram' type alarms.")
         self.__chat_id = require_and_remove_key('chat_id', settings, "'Telegram' type alarms.")
         self.__client = None
+        self.__chat_locks = {}
 
         # Optional Alarm Parameters
         self.__venue = parse_boolean(settings.pop('venue', "False"))
@@ -52,6 +60,7 @@ class TelegramAlarm(Alarm):
         self.__stickers = parse_boolean(settings.pop('stickers', 'True'))
         self.__disable_map_notification = parse_boolean(settings.pop('disable_map_notification', "True"))
         self.__startup_message = parse_boolean(settings.pop('startup_message', "True"))
+        self.__retry = RetryPolicy('Telegram', settings.pop('retry', {}))  # How to handle failed messages
 
         # Optional Alert Parameters
         self.__pokemon = self.create_alert_settings(settings.pop('pokemon', {}), self._defaults['pokemon'])
@@ -63,9 +72,11 @@ class TelegramAlarm(Alarm):
 
         log.info("Telegram Alarm has been created!")
 
-    # (Re)establishes Telegram connection
+    # Establishes Telegram connection (the client is stateless, so the pool takes care of any reconnecting)
     def connect(self):
-        self.__client = telepot.Bot(self.__bot_token)
+        if self.__client is None:
+            telepot.api._pools['default'] = get_pool_manager()  # Send through the shared connection pools
+            self.__client = telepot.Bot(self.__bot_token)
 
     # Sends a start up message on Telegram
     def startup_message(self):
@@ -90,17 +101,43 @@ class TelegramAlarm(Alarm):
 
     # Send Alert to Telegram
     def send_alert(self, alert, info, sticker_id=None):
-        if sticker_id:
-            self.send_sticker(alert['chat_id'], sticker_id)
-
-        if alert['venue']:
-            self.send_venue(alert, info)
-        else:
-            text = '<b>' + replace(alert['title'], info) + '</b> \n' + replace(alert['body'], info)
-            self.send_message(alert['chat_id'], text)
-
-        if alert['location']:
-            self.send_location(alert, info)
+        extras = LoadControl.get_level() < LoadControl.NO_EXTRAS  # Stickers and locations wait until caught up
+        # Telegram shows messages in the order they arrive, so alerts for the same chat take turns
+        with self.get_chat_lock(alert['chat_id']):
+            if sticker_id and extras:
+                self.send_sticker(alert['chat_id'], sticker_id)
+
+            if alert['venue']:  # A venue already includes the location
+                self.send_venue(alert, info)
+            else:
+                text = '<b>' + replace(alert['title'], info) + '</b> \n' + replace(alert['body'], info)
+                self.send_message(alert['chat_id'], text)
+                if alert['location'] and extras:
+                    self.send_location(alert, info)
+
+    # Returns the lock that keeps the messages of an alert together in its chat
+    def get_chat_lock(self, chat_id):
+        lock = self.__chat_locks.get(chat_id)
+        if lock is None:
+            lock = self.__chat_locks[chat_id] = Semaphore()
+        return lock
+
+    # Send Alerts for several events at once, combined into as few messages as possible
+    def send_batch(self, kind, events):
+        alert = {'pokemon': self.__pokemon, 'pokestop': self.__pokestop, 'gym': self.__gym}[kind]
+        text = ''
+        for info in events:  # Stickers and locations can't be combined, so link to the map instead
+            entry = '<b>' + replace(alert['title'], info) + '</b> \n' + replace(alert['body'], info)
+            if alert['venue'] or alert['location']:
+                entry += ' \n<a href="{}">Map</a>'.format(info['gmaps'])
+            if len(text) > 0 and len(text) + len(entry) + 2 > self._max_length:
+                with self.get_chat_lock(alert['chat_id']):  # Don't land in the middle of another alert
+                    self.send_message(alert['chat_id'], text)
+                text = ''
+            text += ('\n\n' if len(text) > 0 else '') + entry
+        if len(text) > 0:
+            with self.get_chat_lock(alert['chat_id']):
+                self.send_message(alert['chat_id'], text)
 
     # Trigger an alert based on Pokemon info
     def pokemon_alert(self, pokemon_info):
@@ -132,7 +169,8 @@ class TelegramAlarm(Alarm):
             'disable_notification': 'False',
             'parse_mode': 'HTML'
         }
-        try_sending(log, self.connect, "Telegram", self.__client.sendMessage, args)
+        try_sending(log, self.connect, "Telegram", self.call_api, {'method': 'sendMessage', 'params': args},
+                    self.__retry, chat_id)
 
     # Send a sticker to telegram
     def send_sticker(self, chat_id, sticker_id):
@@ -141,7 +179,8 @@ class TelegramAlarm(Alarm):
             'sticker': unicode(sticker_id),
             'disable_notification': 'True'
         }
-        try_sending(log, self.connect, 'Telegram (sticker)', self.__client.sendSticker, args)
+        try_sending(log, self.connect, 'Telegram (sticker)', self.call_api,
+                    {'method': 'sendSticker', 'params': args}, self.__retry, chat_id)
 
     # Send a venue message to telegram
     def send_venue(self, alert, info):
@@ -153,7 +192,8 @@ class TelegramAlarm(Alarm):
             'address': replace(alert['body'], info),
             'disable_notification': 'False'
         }
-        try_sending(log, self.connect, "Telegram (venue)", self.__client.sendVenue, args)
+        try_sending(log, self.connect, "Telegram (venue)", self.call_api, {'method': 'sendVenue', 'params': args},
+                    self.__retry, alert['chat_id'])
 
     # Send a location message to telegram
     def send_location(self, alert, info):
@@ -163,4 +203,21 @@ class TelegramAlarm(Alarm):
             'longitude': info['lng'],
             'disable_notification': "{}".format(alert['disable_map_notification'])
         }
-        try_sending(log, self.connect, "Telegram (location)", self.__client.sendLocation, args)
+        try_sending(log, self.connect, "Telegram (location)", self.call_api,
+                    {'method': 'sendLocation', 'params': args}, self.__retry, alert['chat_id'])
+
+    # Call the Bot API while staying under Telegram's flood limits for both the chat and the bot
+    def call_api(self, method, params):
+        chat_id = str(params['chat_id'])
+        if chat_id.startswith('-'):  # Groups and channels get 20 messages a minute
+            chat = get_bucket((self.__bot_token, chat_id), "Telegram chat {}".format(chat_id), 20 / 60.0, 20)
+        else:  # Private chats get about 1 message a second
+            chat = get_bucket((self.__bot_token, chat_id), "Telegram chat {}".format(chat_id), 1, 1)
+        chat.acquire()
+        get_bucket(self.__bot_token, "Telegram bot", 30, 30).acquire()  # 30 messages a second overall
+        try:
+            return getattr(self.__client, method)(**params)
+        except telepot.exception.TooManyRequestsError as e:
+            retry_after = float(((e.json or {}).get('parameters') or {}).get('retry_after', 1))
+            chat.pause(retry_after)
+            raise RateLimitError("Telegram flood limit reached for chat {}.".format(chat_id), retry_after)
@@ -0,0 +1,77 @@
+# Standard Library Imports
+import json
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+# 3rd Party Imports
+# Local Imports
+import Metrics
+
+log = logging.getLogger('Trace')
+
+# Stages an event passes through, in order (each is stamped with the time it was reached)
+STAGES = ['received', 'dispatched', 'dequeued', 'filtered', 'enriched', 'rendered', 'sent']
+
+# Trace log settings (set by the main process before the Managers are started)
+_log_path = None
+_sample_rate = 0.0  # Fraction of events written to the trace log
+_file, _file_pid = None, None  # Each process opens the log for itself
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# Set up the trace log (a path of None turns it off)
+def configure(log_path, sample_rate):
+    global _log_path, _sample_rate
+    _log_path = log_path
+    _sample_rate = max(0.0, min(1.0, sample_rate)) if log_path is not None else 0.0
+
+
+# Returns a new trace for an event received at the given time
+def start(received_at):
+    return {'received': received_at}
+
+
+# Stamp the trace with the time it reached the stage, recording how long it took to get there from the last one
+def mark(trace, stage, now=None):
+    if trace is None:
+        return
+    now = now or time.time()
+    previous = max(trace.values())
+    trace[stage] = now
+    Metrics.observe('pokealarm_stage_seconds', now - previous, {'stage': stage}, STAGE_BUCKETS)
+
+
+# Record the end of a trace for the alarm, writing it to the trace log if the event was sampled
+def finish(trace, kind, id_, alarm, outcome):
+    if trace is None:
+        return
+    Metrics.observe('pokealarm_event_latency_seconds', trace['sent'] - trace['received'], {'alarm': alarm})
+    if _sample_rate > 0 and is_sampled(id_):
+        write({
+            'id': id_,
+            'type': kind,
+            'manager': multiprocessing.current_process().name,
+            'alarm': alarm,
+            'outcome': outcome,
+            'received': trace['received'],
+            'stages': dict((stage, round(trace[stage] - trace['received'], 6)) for stage in STAGES if stage in trace)
+        })
+
+
+# Returns true if the event should be written to the trace log (the same for every process and alarm)
+def is_sampled(id_):
+    return (zlib.crc32(str(id_)) & 0xffffffff) < _sample_rate * 0x100000000
+
+
+def write(record):
+    global _file, _file_pid
+    try:
+        if _file is None or _file_pid != os.getpid():
+            _file, _file_pid = open(_log_path, 'a'), os.getpid()
+        _file.write(json.dumps(record, separators=(',', ':')) + '\n')  # One write per line keeps processes apart
+        _file.flush()
+    except Exception as e:
+        log.error("Could not write to the trace log: {}: {}".format(type(e).__name__, e))
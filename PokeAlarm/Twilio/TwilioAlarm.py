@@ -4,6 +4,8 @@ import logging
 from twilio.rest import TwilioRestClient
 # Local Imports
 from ..Alarm import Alarm
+from ..Digest import Digest
+from ..Retry import RetryPolicy
 from ..Utils import parse_boolean, require_and_remove_key, reject_leftover_parameters
 
 log = logging.getLogger('Twilio')
@@ -43,6 +45,9 @@ class TwilioAlarm(Alarm):
 
         # Optional Alarm Parameters
         self.__startup_message = parse_boolean(settings.pop('startup_message', "True"))
+        self.__retry = RetryPolicy('Twilio', settings.pop('retry', {}))  # How to handle failed messages
+        digest = settings.pop('digest', None)  # Send alerts as a summary every so often instead
+        self.__digest = Digest('Twilio', digest, self.send_digest, 320) if digest is not None else None
 
         # Optional Alert Parameters
         self.__pokemon = self.set_alert(settings.pop('pokemon', {}), self._defaults['pokemon'])
@@ -81,6 +86,9 @@ class TwilioAlarm(Alarm):
 
     # Send Pokemon Info
     def send_alert(self, alert, info):
+        if self.__digest is not None:
+            self.__digest.add((alert['to_number'], alert['from_number']), replace(alert['message'], info))
+            return
         self.send_sms(
             to_num=alert['to_number'],
             from_num=alert['from_number'],
@@ -99,6 +107,10 @@ class TwilioAlarm(Alarm):
     def gym_alert(self, gym_info):
         self.send_alert(self.__gym, gym_info)
 
+    # Send a summary of alerts to the (to, from) numbers
+    def send_digest(self, numbers, body):
+        self.send_sms(to_num=numbers[0], from_num=numbers[1], body=body)
+
     # Send a SMS message
     def send_sms(self, to_num, from_num, body):
         args = {
@@ -106,4 +118,4 @@ class TwilioAlarm(Alarm):
             'from_': from_num,
             'body': body
         }
-        try_sending(log, self.connect, "Twilio", self.__client.messages.create, args)
+        try_sending(log, self.connect, "Twilio", self.__client.messages.create, args, self.__retry, to_num)
@@ -5,6 +5,8 @@ import logging
 from twitter import Twitter, OAuth
 # Local Imports
 from ..Alarm import Alarm
+from ..Digest import Digest
+from ..Retry import RetryPolicy
 from ..Utils import parse_boolean, get_time_as_str, require_and_remove_key, reject_leftover_parameters
 
 log = logging.getLogger('Twitter')
@@ -44,6 +46,9 @@ class TwitterAlarm(Alarm):
 
         # Optional Alarm Parameters
         self.__startup_message = parse_boolean(settings.pop('startup_message', "True"))
+        self.__retry = RetryPolicy('Twitter', settings.pop('retry', {}))  # How to handle failed messages
+        digest = settings.pop('digest', None)  # Tweet alerts as a summary every so often instead
+        self.__digest = Digest('Twitter', digest, self.send_digest, 280) if digest is not None else None
 
         # Optional Alert Parameters
         self.__pokemon = self.create_alert_settings(settings.pop('pokemon', {}), self._defaults['pokemon'])
@@ -65,7 +70,7 @@ class TwitterAlarm(Alarm):
         if self.__startup_message:
             timestamps = get_time_as_str(datetime.utcnow())
             args = {"status": "{}- PokeAlarm activated!" .format(timestamps[2])}
-            try_sending(log, self.connect, "Twitter", self.send_tweet, args)
+            try_sending(log, self.connect, "Twitter", self.send_tweet, args, self.__retry)
             log.info("Startup tweet sent!")
 
     # Set the appropriate settings for each alert
@@ -77,8 +82,15 @@ class TwitterAlarm(Alarm):
         return alert
 
     def send_alert(self, alert, info):
+            if self.__digest is not None:
+                self.__digest.add(None, replace(alert['status'], info))
+                return
             args = {"status": replace(alert['status'], info)}
-            try_sending(log, self.connect, "Twitter", self.__client.statuses.update, args)
+            try_sending(log, self.connect, "Twitter", self.__client.statuses.update, args, self.__retry)
+
+    # Tweet a summary of alerts
+    def send_digest(self, destination, status):
+        try_sending(log, self.connect, "Twitter", self.__client.statuses.update, {"status": status}, self.__retry)
 
     # Trigger an alert based on Pokemon info
     def pokemon_alert(self, pokemon_info):
@@ -313,13 +313,17 @@ def get_earth_dist(pt_a, pt_b=None):
     lng_delta = lng_b - lng_a
     a = sin(lat_delta / 2) ** 2 + cos(lat_a) * cos(lat_b) * sin(lng_delta / 2) ** 2
     c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    radius = 6373000  # radius of earth in meters
-    if config['UNITS'] == 'imperial':
-        radius = 6975175  # radius of earth in yards
-    dist = c * radius
+    dist = c * get_earth_radius()
     return dist
 
 
+# Returns the radius of the earth in the units being used
+def get_earth_radius():
+    if config['UNITS'] == 'imperial':
+        return 6975175  # radius of earth in yards
+    return 6373000  # radius of earth in meters
+
+
 # Return the time as a string in different formats
 def get_time_as_str(t, timezone=None):
     if timezone is None:
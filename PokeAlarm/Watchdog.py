@@ -0,0 +1,99 @@
+# Standard Library Imports
+import logging
+import sys
+import time
+import traceback
+# 3rd Party Imports
+import gevent
+from gevent import monkey
+import greenlet
+# Local Imports
+import Metrics
+
+log = logging.getLogger('Watchdog')
+
+# Real threads and sleeps (the watchdog has to keep running while the greenlets are stuck)
+_start_new_thread = monkey.get_original('thread', 'start_new_thread')
+_get_ident = monkey.get_original('thread', 'get_ident')
+_sleep = monkey.get_original('time', 'sleep')
+
+
+# Watches from a separate thread for greenlets that keep the gevent hub from switching for too long
+class HubWatchdog(object):
+
+    def __init__(self, name, threshold):
+        self.__name = name
+        self.__threshold = threshold  # Seconds without a switch that count as blocking
+        self.__switches = 0  # Bumped on every switch, so the thread can tell if anything has happened
+        self.__current = None  # Greenlet that was switched to last
+        self.__previous_trace = None
+        self.__hub, self.__thread_id = None, None
+        self.__reports = []  # Left by the thread for the hub to log (logging from the thread could deadlock)
+        self.__blocks, self.__longest = 0, 0.0
+
+    # Start watching the hub of the current thread
+    def start(self):
+        self.__hub, self.__thread_id = gevent.get_hub(), _get_ident()
+        self.__previous_trace = greenlet.settrace(self.trace)
+        _start_new_thread(self.watch, ())
+        gevent.spawn(self.report)
+        log.info("Watching {} for greenlets that block for more than {:.2f}s.".format(self.__name, self.__threshold))
+
+    # Called by greenlet on every switch - needs to be as cheap as possible
+    def trace(self, event, args):
+        self.__switches += 1
+        if event == 'switch' or event == 'throw':
+            self.__current = args[1]
+        if self.__previous_trace is not None:
+            self.__previous_trace(event, args)
+
+    # Check in on the hub every so often (runs in its own thread)
+    def watch(self):
+        last_switches, last_change = self.__switches, time.time()
+        blocked_since = None
+        while True:
+            _sleep(self.__threshold / 2.0)
+            now = time.time()
+            # Switching, or waiting on I/O in the hub
+            if self.__switches != last_switches or self.__current is self.__hub:
+                if blocked_since is not None:
+                    self.__reports.append(('end', now - blocked_since, None, None))
+                    blocked_since = None
+                last_switches, last_change = self.__switches, now
+            elif blocked_since is None and now - last_change >= self.__threshold:
+                blocked_since = last_change
+                frame = sys._current_frames().get(self.__thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else "(unavailable)\n"
+                self.__reports.append(('block', now - last_change, repr(self.__current), stack))
+
+    # Log what the thread saw once the hub is free again
+    def report(self):
+        while True:
+            gevent.sleep(1)
+            while len(self.__reports) > 0:
+                kind, seconds, current, stack = self.__reports.pop(0)
+                if kind == 'block':
+                    self.__blocks += 1
+                    Metrics.inc('pokealarm_hub_blocks_total')
+                    log.warning("{} did not switch greenlets for {:.2f}s - {} was blocking the hub at:\n{}".format(
+                        self.__name, seconds, current, stack))
+                else:
+                    self.__longest = max(self.__longest, seconds)
+                    Metrics.observe('pokealarm_hub_block_seconds', seconds)
+                    log.warning("{} was blocked for about {:.2f}s in total.".format(self.__name, seconds))
+
+    # Returns a dict of the number of blocking episodes and the longest one
+    def get_stats(self):
+        return {
+            'blocks': self.__blocks,
+            'longest': self.__longest
+        }
+
+
+# Start a watchdog for this process (a threshold of 0 disables it)
+def start(name, threshold):
+    if threshold <= 0:
+        return None
+    watchdog = HubWatchdog(name, threshold)
+    watchdog.start()
+    return watchdog
@@ -12,17 +12,22 @@ logging.basicConfig(format='%(asctime)s [%(processName)15.15s][%(name)10.10s][%(
 
 # Standard Library Imports
 import configargparse
+import gevent
 from gevent import wsgi, spawn
 import pytz
 import Queue
 import json
+import math
 import os
+import signal
 import sys
+import time
 # 3rd Party Imports
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 # Local Imports
-from PokeAlarm import config
+from PokeAlarm import config, Dedupe, Metrics, Profiler, Trace, Watchdog
 from PokeAlarm.Manager import Manager
+from PokeAlarm.QueueLag import LagMonitor
 from PokeAlarm.WebhookStructs import RocketMap
 from PokeAlarm.Utils import get_path, parse_unicode
 
@@ -37,6 +42,7 @@ log = logging.getLogger('Server')
 # Global Variables
 app = Flask(__name__)
 data_queue = Queue.Queue()
+data_queue_lag = LagMonitor("Webhook queue")
 managers = {}
 
 
@@ -50,21 +56,92 @@ def accept_webhook():
     try:
         log.debug("POST request received from {}.".format(request.remote_addr))
         data = json.loads(request.data)
-        data_queue.put(data)
+        data_queue.put((time.time(), data))  # Stamped so that the age of the queue can be reported
     except Exception as e:
         log.error("Encountered error while receiving webhook ({}: {})".format(type(e).__name__, e))
+        Metrics.inc('pokealarm_webhook_failures_total', {'stage': 'receive'})
         abort(400)
     return "OK"  # request ok
 
 
+# Report how PokeAlarm is doing in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    Metrics.set_gauge('pokealarm_ingress_queue_depth', None, data_queue.qsize())
+    try:
+        age = time.time() - data_queue.queue[0][0]
+    except IndexError:
+        age = 0.0
+    Metrics.set_gauge('pokealarm_ingress_queue_age_seconds', None, age)
+    Metrics.set_gauge('pokealarm_ingress_queue_wait_seconds', None, data_queue_lag.get_average())
+    for name, mgr in managers.iteritems():
+        Metrics.set_gauge('pokealarm_manager_queue_depth', {'manager': name}, mgr.get_queue_size())
+        age, wait = mgr.get_queue_lag()
+        Metrics.set_gauge('pokealarm_manager_queue_age_seconds', {'manager': name}, age)
+        Metrics.set_gauge('pokealarm_manager_queue_wait_seconds', {'manager': name}, wait)
+    return Response(Metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Profile the server (target=main) or a Manager for a number of seconds, writing the result to the profile_path
+@app.route('/profile', methods=['POST'])
+def profile():
+    target = request.args.get('target', 'main').lower()  # Manager names are kept in lowercase
+    mode = request.args.get('mode', 'sample')
+    try:
+        seconds = float(request.args.get('seconds', 30))
+    except ValueError:
+        abort(400)
+    if config['PROFILE_PATH'] is None:
+        abort(404)
+    try:
+        if target == 'main':
+            return "Profiling main for {}s: {}".format(seconds, Profiler.start('main', mode, seconds))
+        Profiler.check_settings(mode, seconds)  # Reported here, instead of only in the Manager's log
+    except Profiler.ProfileError as e:
+        return "Could not start profile: {}".format(e), 400
+    if target not in managers:
+        abort(404)
+    managers[target].request_profile(mode, seconds)
+    return "Profiling {} for {}s (see its log for the file).".format(target, seconds)
+
+
+# Returns how often each of a Manager's filters was checked and passed, as JSON
+@app.route('/filter_stats/<name>', methods=['GET'])
+def filter_stats(name):
+    if name.lower() not in managers:
+        abort(404)
+    stats = managers[name.lower()].request_filter_stats()
+    if stats is None:
+        return "Manager did not answer in time.", 503
+    return Response(json.dumps(make_json_safe(stats), allow_nan=False, indent=2, sort_keys=True),
+                    mimetype='application/json')
+
+
+# Returns a copy of the value that strict JSON parsers can read (infinite limits are written "inf", as in the filters
+# file, and sets become lists)
+def make_json_safe(value):
+    if isinstance(value, float) and (math.isinf(value) or math.isnan(value)):
+        return None if math.isnan(value) else ("inf" if value > 0 else "-inf")
+    if isinstance(value, dict):
+        return dict((key, make_json_safe(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return [make_json_safe(item) for item in value]
+    return value
+
+
 # Thread used to distribute the data into various processes (for PokemonGo-Map format)
 def manage_webhook_data(queue):
     while True:
-        if queue.qsize() > 300:
-            log.warning("Queue length is at {}... this may be causing a delay in notifications.".format(queue.qsize()))
-        data = queue.get(block=True)
+        received_at, data = queue.get(block=True)
+        data_queue_lag.record(received_at)  # Warns if webhooks are waiting too long
+        Metrics.inc('pokealarm_webhooks_received_total',
+                    {'type': data.get('type') if isinstance(data, dict) else 'unknown'})
         obj = RocketMap.make_object(data)
-        if obj is not None:
+        if obj is None:
+            Metrics.inc('pokealarm_webhook_failures_total', {'stage': 'convert'})
+        else:
+            obj['trace'] = Trace.start(received_at)
+            Trace.mark(obj['trace'], 'dispatched')
             for name, mgr in managers.iteritems():
                 mgr.update(obj)
                 log.debug("Distributed to {}.".format(name))
@@ -86,11 +163,19 @@ def start_server():
 
     # Start Webhook Manager in a Thread
     spawn(manage_webhook_data, data_queue)
+    Metrics.start_collector()  # Reads the metrics the Managers send, whether or not /metrics is scraped
+    Watchdog.start("Server", config['BLOCK_THRESHOLD'])
 
     # Start up Server
     log.info("PokeAlarm is listening for webhooks on: http://{}:{}".format(config['HOST'], config['PORT']))
     server = wsgi.WSGIServer((config['HOST'], config['PORT']), app, log=logging.getLogger('pyswgi'))
-    server.serve_forever()
+    gevent.signal(signal.SIGTERM, server.stop)
+    try:
+        server.serve_forever()
+    finally:  # Give the Managers a chance to save their snapshots
+        log.info("PokeAlarm is shutting down...")
+        for m_name in managers:
+            managers[m_name].stop()
 
 
 ################################################## CONFIG UTILITIES  ###################################################
@@ -105,6 +190,18 @@ def parse_settings(root_path):
     parser.add_argument('-d', '--debug', help='Debug Mode', action='store_true', default=False)
     parser.add_argument('-H', '--host', help='Set web server listening host', default='127.0.0.1')
     parser.add_argument('-P', '--port', type=int, help='Set web server listening port', default=4000)
+    parser.add_argument('--http_pool_size', type=int, default=10,
+                        help='Number of keep-alive connections kept open to each host. default: 10')
+    parser.add_argument('--http_connect_timeout', type=float, default=3.0,
+                        help='Seconds to wait when connecting to a service. default: 3.0')
+    parser.add_argument('--http_read_timeout', type=float, default=5.0,
+                        help='Seconds to wait for a service to respond. default: 5.0')
+    parser.add_argument('--queue_age_warning', type=float, default=5.0,
+                        help='Warn when webhooks wait longer than this many seconds to be processed ' +
+                             '(0 to disable). default: 5.0')
+    parser.add_argument('--dedupe_slots', type=int, default=65536,
+                        help='Recent sends remembered to stop Managers from sending the same alert twice ' +
+                             '(16 bytes each, 0 to disable). default: 65536')
     parser.add_argument('-m', '--manager_count', type=int, default=1,
                         help='Number of Manager processes to start.')
     parser.add_argument('-M', '--manager_name', type=parse_unicode, action='append', default=[],
@@ -127,8 +224,32 @@ def parse_settings(root_path):
                         help='Specify either metric or imperial units to use for distance measurements. ')
     parser.add_argument('-tl', '--timelimit', type=int, default=[0], action='append',
                         help='Minimum number of seconds remaining on a pokemon to send a notify')
+    parser.add_argument('-iw', '--iv_wait', type=int, default=[0], action='append',
+                        help='Seconds to hold pokemon without IVs for filters that need them. default: 0 (disabled)')
+    parser.add_argument('-gw', '--gym_window', type=int, default=[0], action='append',
+                        help='Seconds to combine changes to a gym into one notification. default: 0 (disabled)')
+    parser.add_argument('-ml', '--max_lag', type=int, default=[0], action='append',
+                        help='Seconds behind before skipping optional work to catch up. default: 0 (disabled)')
     parser.add_argument('-tz', '--timezone', type=str, action='append', default=[None],
                         help='Timezone used for notifications.  Ex: "America/Los_Angeles"')
+    parser.add_argument('-sp', '--snapshot_path', type=parse_unicode, default=None,
+                        help='Folder to save Manager histories in so they survive restarts. default: None')
+    parser.add_argument('--adaptive_filter_order', action='store_true', default=False,
+                        help='Try the pokemon filters that match most often first. default: False')
+    parser.add_argument('--rejection_samples', type=int, default=6,
+                        help='Rejected events logged per minute by each Manager, as examples (0 for none). ' +
+                             'Every one is logged in debug mode. default: 6')
+    parser.add_argument('--rejection_summary', type=float, default=60,
+                        help='Seconds between summaries of why events were rejected. default: 60')
+    parser.add_argument('--block_threshold', type=float, default=0,
+                        help='Log the stack of any greenlet that keeps the others from running for longer than ' +
+                             'this many seconds (0 to disable). default: 0')
+    parser.add_argument('--profile_path', type=parse_unicode, default=None,
+                        help='Folder to write profiles to (enables the /profile endpoint). default: None')
+    parser.add_argument('--trace_log', type=parse_unicode, default=None,
+                        help='File to write sampled per-event stage timings to, as JSON lines. default: None')
+    parser.add_argument('--trace_sample', type=float, default=0.01,
+                        help='Fraction of events written to the trace log. default: 0.01')
 
     args = parser.parse_args()
 
@@ -142,10 +263,20 @@ def parse_settings(root_path):
     config['HOST'] = args.host
     config['PORT'] = args.port
     config['DEBUG'] = args.debug
+    config['HTTP_POOL_SIZE'] = args.http_pool_size
+    config['HTTP_CONNECT_TIMEOUT'] = args.http_connect_timeout
+    config['HTTP_READ_TIMEOUT'] = args.http_read_timeout
+    config['QUEUE_AGE_WARNING'] = args.queue_age_warning
+    config['BLOCK_THRESHOLD'] = args.block_threshold
+    config['REJECTION_SAMPLES'] = args.rejection_samples
+    config['ADAPTIVE_FILTER_ORDER'] = args.adaptive_filter_order
+    config['REJECTION_SUMMARY'] = args.rejection_summary
+    config['PROFILE_PATH'] = get_path(args.profile_path) if args.profile_path is not None else None
 
     # Check to make sure that the same number of arguements are included
     for list_ in [args.key, args.filters, args.alarms, args.geofences, args.location,
-                  args.locale, args.units, args.timelimit, args.timezone]:
+                  args.locale, args.units, args.timelimit, args.iv_wait, args.gym_window, args.max_lag,
+                  args.timezone]:
         if len(list_) > 1:  # Remove defaults from the list
             list_.pop(0)
         size = len(list_)
@@ -168,6 +299,10 @@ def parse_settings(root_path):
                       "see https://en.wikipedia.org/wiki/List_of_tz_database_time_zones")
             sys.exit(1)
 
+    # Shared by the Managers, so they have to exist before they are started
+    Dedupe.create_table(args.dedupe_slots)
+    Trace.configure(args.trace_log, args.trace_sample)
+
     # Build the managers
     for m_ct in range(args.manager_count):
         # This needs to be changed a few times... because
@@ -179,16 +314,21 @@ def parse_settings(root_path):
             units=args.units[m_ct] if len(args.units) > 1 else args.units[0],
             timezone=args.timezone[m_ct] if len(args.timezone) > 1 else args.timezone[0],
             time_limit=args.timelimit[m_ct] if len(args.timelimit) > 1 else args.timelimit[0],
+            iv_wait=args.iv_wait[m_ct] if len(args.iv_wait) > 1 else args.iv_wait[0],
+            gym_window=args.gym_window[m_ct] if len(args.gym_window) > 1 else args.gym_window[0],
+            max_lag=args.max_lag[m_ct] if len(args.max_lag) > 1 else args.max_lag[0],
             quiet=False,  # TODO: I'll totally document this some day. Promise.
             location=args.location[m_ct] if len(args.location) > 1 else args.location[0],
             filter_file=args.filters[m_ct] if len(args.filters) > 1 else args.filters[0],
             geofence_file=args.geofences[m_ct] if len(args.geofences) > 1 else args.geofences[0],
             alarm_file=args.alarms[m_ct] if len(args.alarms) > 1 else args.alarms[0],
+            snapshot_path=args.snapshot_path,
             debug=config['DEBUG']
         )
         if m.get_name() not in managers:
             # Add the manager to the map
             managers[m.get_name()] = m
+            Metrics.create_channel(m.get_name())
         else:
             log.critical("Names of Manager processes must be unique (regardless of capitalization)! Process will exit.")
             sys.exit(1)